@@ -0,0 +1,169 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Per-device admission control for POST /diagnostics.
+# Every client_id has a token bucket holding up to `burst` requests, refilled at `rate` per
+# second. A request that finds no token is refused (the caller answers 429 with Retry-After)
+# and its newest reading is parked as the device's pending reading instead of being processed;
+# later refused readings replace it, so a device looping on POST costs at most one processed
+# reading per token. The pending reading is handed to submit() once the device has a token
+# again, or dropped when an admitted request brings a newer one first. A request carrying an
+# alert may claim an exemption: it takes a token when there is one but is never refused, so the
+# alert is never collapsed away. Each device gets one exemption per exempt_interval seconds, so
+# a device looping on alerts is limited like any other. rate <= 0 admits everything.
+
+
+class Admission:
+    def __init__(self, rate=1.0, burst=10, max_devices=4096, exempt_interval=5.0, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self.max_devices = max_devices
+        self.exempt_interval = exempt_interval
+        self.clock = clock
+        # client_id -> [tokens, last refill], least recently used first
+        self.buckets = OrderedDict()
+        # client_id -> time of its last exemption, least recently used first
+        self.exempted = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.submit = None
+        self.thread = None
+        self.running = False
+        self.collapsed = 0
+        self.on_collapsed = None
+
+    # submit(reading) -> True once the reading is queued for processing. With background=False
+    # the caller drives release() itself.
+    def start(self, submit, background=True):
+        self.submit = submit
+        self.running = True
+        if not background or self.rate <= 0:
+            return
+        self.thread = threading.Thread(target=self._run, name="admission", daemon=True)
+        self.thread.start()
+        logger.info(f"Started diagnostics admission control (rate={self.rate}/s, burst={self.burst:g})")
+
+    def _bucket(self, client_id, now):
+        bucket = self.buckets.get(client_id)
+        if bucket is None:
+            bucket = self.buckets[client_id] = [self.burst, now]
+            # Forgetting a device only gives it a full bucket again
+            while len(self.buckets) > self.max_devices:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    # Seconds until the bucket holds a whole token
+    def _wait(self, bucket):
+        return max(0.0, (1 - bucket[0]) / self.rate)
+
+    # True when the device has not been granted an exemption in the last exempt_interval
+    # seconds; the grant is recorded, so the caller must then admit the request as exempt
+    def claim_exemption(self, client_id):
+        with self.lock:
+            now = self.clock()
+            last = self.exempted.get(client_id)
+            if last is not None and now - last < self.exempt_interval:
+                return False
+            self.exempted[client_id] = now
+            self.exempted.move_to_end(client_id)
+            while len(self.exempted) > self.max_devices:
+                self.exempted.popitem(last=False)
+        return True
+
+    # Take a token for one request: 0 when admitted, otherwise the seconds until the next token.
+    # exempt requests are admitted even without a token.
+    def admit(self, client_id, exempt=False):
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            bucket = self._bucket(client_id, self.clock())
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+            elif not exempt:
+                return self._wait(bucket)
+            superseded = self.pending.pop(client_id, None)
+        if superseded is not None:
+            self._count_collapsed(1)
+        return 0.0
+
+    # Park the newest of a refused request's readings (oldest first, all from one device) as the
+    # device's pending reading
+    def defer(self, readings):
+        if not readings:
+            return
+        latest = readings[-1]
+        with self.lock:
+            replaced = self.pending.get(latest["client_id"])
+            self.pending[latest["client_id"]] = latest
+        self._count_collapsed(len(readings) - 1 + (replaced is not None))
+        self.wakeup.set()
+
+    def _count_collapsed(self, count):
+        if not count:
+            return
+        self.collapsed += count
+        if self.on_collapsed is not None:
+            self.on_collapsed(count)
+
+    def depth(self):
+        return len(self.pending)
+
+    # Submit the pending readings whose device has a token again; returns the seconds until the
+    # next one is due (None when nothing is pending)
+    def release(self):
+        due, next_due = [], None
+        with self.lock:
+            now = self.clock()
+            for client_id in list(self.pending):
+                bucket = self._bucket(client_id, now)
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    due.append(self.pending.pop(client_id))
+                else:
+                    wait = self._wait(bucket)
+                    next_due = wait if next_due is None else min(next_due, wait)
+        for reading in due:
+            if not self.submit(reading):
+                # Ingest queue full: keep it for the next round unless a newer one arrived
+                with self.lock:
+                    self.pending.setdefault(reading["client_id"], reading)
+                next_due = 1 / self.rate if next_due is None else min(next_due, 1 / self.rate)
+        return next_due
+
+    def _run(self):
+        while self.running:
+            try:
+                next_due = self.release()
+            except Exception as e:
+                logger.error(f"Failed to release pending diagnostics: {e}")
+                next_due = 1.0
+            self.wakeup.wait(next_due if next_due is not None else None)
+            self.wakeup.clear()
+
+    # Stop the release thread and hand over every pending reading regardless of tokens, so the
+    # latest state of each device is not lost on shutdown
+    def stop(self, timeout=5):
+        self.running = False
+        if self.thread is not None:
+            self.wakeup.set()
+            self.thread.join(timeout)
+            self.thread = None
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for reading in pending.values():
+            self.submit(reading)
+
+    # Retry-After header value: whole seconds, at least 1
+    @staticmethod
+    def retry_after(seconds):
+        return max(1, math.ceil(seconds))
@@ -0,0 +1,308 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import frames
+from mqtt_broker import Broker
+
+# Load test for test_server.py against a local stand-in broker.
+#
+#   python bench/load_test.py --devices 500 --mobiles 20 --duration 20
+#
+# Starts the in-process broker, runs the real server as a subprocess (no TLS, DB and
+# signals.log in a temporary directory), then drives it with simulated ESP32s posting
+# /diagnostics and simulated mobile apps publishing server/request/mobile. Reports ingest
+# throughput and latency, wire/lock end-to-end latency, DB write rate and memory per device.
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_server.py")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Resident memory (KiB) of a process and its children
+def rss_kib(pid):
+    pids = {pid}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.add(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    total = 0
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+# Remembers when each alert / state message was published per device, for latency measurement
+class AlertRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.alerts = {}
+
+    def expect(self, device_id, state, reason):
+        event = threading.Event()
+        with self.lock:
+            self.waiters[(device_id, state, reason)] = [event, None]
+        return event
+
+    def result(self, device_id, state, reason):
+        with self.lock:
+            return self.waiters.pop((device_id, state, reason))[1]
+
+    def on_publish(self, topic, payload, timestamp):
+        if topic != "esp32/alter/state":
+            return
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        key = (message.get("device_id"), message.get("state"), message.get("reason"))
+        with self.lock:
+            if message.get("state") == "alert":
+                self.alerts[message.get("reason")] = self.alerts.get(message.get("reason"), 0) + 1
+            waiter = self.waiters.get(key)
+            if waiter is not None and waiter[1] is None:
+                waiter[1] = timestamp
+                waiter[0].set()
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bantaybike-bench-")
+        self.db_path = os.path.join(self.workdir, "bench.db")
+        self.http_port = free_port()
+        self.recorder = AlertRecorder()
+        self.broker = Broker(on_publish=self.recorder.on_publish)
+        self.server = None
+
+    def start(self):
+        self.broker.start()
+        env = dict(
+            os.environ,
+            EMQX_BROKER="127.0.0.1",
+            EMQX_PORT=str(self.broker.port),
+            EMQX_USERNAME="bench",
+            EMQX_PASSWORD="bench",
+            EMQX_TLS="0",
+            PORT=str(self.http_port),
+            DB_PATH=self.db_path,
+            SHARDS=str(self.args.shards),
+            SHARD_PORT_BASE=str(free_port()),
+            DIAGNOSTICS_RATE=str(self.args.device_rate),
+        )
+        self.log = open(os.path.join(self.workdir, "server.log"), "w")
+        self.server = subprocess.Popen([sys.executable, SERVER], cwd=self.workdir, env=env,
+                                       stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                raise RuntimeError(f"Server exited early, see {self.log.name}")
+            try:
+                self.request("GET", "/")
+                if self.broker.subscribers("server/request/mobile") >= self.args.shards:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"Server did not come up, see {self.log.name}")
+
+    def stop(self):
+        if self.server is not None and self.server.poll() is None:
+            self.server.terminate()
+            try:
+                self.server.wait(10)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+        self.broker.stop()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.http_port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    def post_diagnostics(self, device_id, reason="null", state="lock"):
+        reading = {
+            "client_id": device_id,
+            "state": state,
+            "battery_level": random.randint(10, 100),
+            "gps_lat": 14.6549 + random.uniform(-0.00002, 0.00002),
+            "gps_lon": 121.0645 + random.uniform(-0.00002, 0.00002),
+            "reason": reason,
+        }
+        if self.args.binary:
+            body = frames.encode(device_id, [reading])
+            headers = {"Content-Type": frames.CONTENT_TYPE}
+        else:
+            body = json.dumps(reading)
+            headers = {"Content-Type": "application/json"}
+        started = time.perf_counter()
+        status = self.request("POST", "/diagnostics", body, headers)
+        return status, time.perf_counter() - started
+
+    def db_rows(self):
+        paths = [self.db_path] if self.args.shards == 1 else [
+            f"{os.path.splitext(self.db_path)[0]}.shard{index}.db" for index in range(self.args.shards)
+        ]
+        rows = 0
+        for path in paths:
+            try:
+                with sqlite3.connect(path) as conn:
+                    rows += conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return rows
+
+    # N devices posting as fast as the client concurrency allows for the configured duration
+    def run_ingest(self):
+        devices = [f"bench-{index:05d}" for index in range(self.args.devices)]
+        latencies, statuses = [], {}
+        lock = threading.Lock()
+        stop_at = time.time() + self.args.duration
+        counter = iter(range(10 ** 9))
+
+        def worker():
+            while time.time() < stop_at:
+                device_id = devices[next(counter) % len(devices)]
+                status, latency = self.post_diagnostics(device_id)
+                with lock:
+                    latencies.append(latency)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.time()
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            for _ in range(self.args.concurrency):
+                pool.submit(worker)
+        return latencies, statuses, time.time() - started
+
+    # Wire alerts: time from POST sent to the alert reaching the broker
+    def run_wire_alerts(self, count):
+        latencies = []
+        for index in range(count):
+            device_id = f"bench-wire-{index:04d}"
+            event = self.recorder.expect(device_id, "alert", "wire")
+            started = time.perf_counter()
+            self.post_diagnostics(device_id, reason="wire")
+            if event.wait(10):
+                latencies.append(self.recorder.result(device_id, "alert", "wire") - started)
+        return latencies
+
+    # Mobile lock requests: time from publish to the server's lock command on esp32/alter/state
+    def run_mobile(self, count):
+        latencies = []
+        lock = threading.Lock()
+
+        def mobile(index):
+            device_id = f"bench-{index % max(1, self.args.devices):05d}"
+            event = self.recorder.expect(device_id, "lock", "null")
+            started = time.perf_counter()
+            self.broker.inject("server/request/mobile", json.dumps({"state": "lock", "device_id": device_id}))
+            if event.wait(10):
+                with lock:
+                    latencies.append(self.recorder.result(device_id, "lock", "null") - started)
+
+        with ThreadPoolExecutor(max(1, self.args.mobiles)) as pool:
+            list(pool.map(mobile, range(count)))
+        return latencies
+
+    def run(self):
+        self.start()
+        try:
+            time.sleep(1)
+            baseline_rss = rss_kib(self.server.pid)
+            rows_before = self.db_rows()
+
+            latencies, statuses, elapsed = self.run_ingest()
+            time.sleep(1)
+            rows_after = self.db_rows()
+            loaded_rss = rss_kib(self.server.pid)
+
+            wire = self.run_wire_alerts(self.args.alerts)
+            mobile = self.run_mobile(self.args.mobiles)
+            return {
+                "devices": self.args.devices,
+                "shards": self.args.shards,
+                "requests": len(latencies),
+                "statuses": statuses,
+                "ingest_per_second": len(latencies) / elapsed,
+                "post_p50_ms": percentile(latencies, 0.50) * 1000,
+                "post_p99_ms": percentile(latencies, 0.99) * 1000,
+                "wire_alert_p50_ms": percentile(wire, 0.50) * 1000,
+                "wire_alert_p99_ms": percentile(wire, 0.99) * 1000,
+                "wire_alerts_seen": f"{len(wire)}/{self.args.alerts}",
+                "mobile_lock_p50_ms": percentile(mobile, 0.50) * 1000,
+                "mobile_lock_p99_ms": percentile(mobile, 0.99) * 1000,
+                "mobile_locks_seen": f"{len(mobile)}/{self.args.mobiles}",
+                "db_rows_per_second": (rows_after - rows_before) / elapsed,
+                "rss_kib_per_device": (loaded_rss - baseline_rss) / max(1, self.args.devices),
+                "broker_messages_in": self.broker.messages_in,
+                "alerts_by_reason": dict(self.recorder.alerts),
+                "mean_post_ms": statistics.fmean(latencies) * 1000 if latencies else float("nan"),
+            }
+        finally:
+            self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the BantayBike server against a local MQTT broker")
+    parser.add_argument("--devices", type=int, default=200, help="simulated ESP32 locks")
+    parser.add_argument("--mobiles", type=int, default=10, help="simulated mobile apps sending lock requests")
+    parser.add_argument("--duration", type=float, default=10, help="ingest phase length in seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent HTTP clients")
+    parser.add_argument("--alerts", type=int, default=20, help="wire alerts to time end to end")
+    parser.add_argument("--binary", action="store_true", help="post binary frames instead of JSON")
+    parser.add_argument("--shards", type=int, default=1, help="run the server with SHARDS worker processes")
+    parser.add_argument("--device-rate", type=float, default=0, help="per-device POST rate limit (DIAGNOSTICS_RATE, default: unlimited)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = LoadTest(args).run()
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>22}: {value:.2f}" if isinstance(value, float) else f"{key:>22}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import struct
+import threading
+import time
+
+# Minimal in-process MQTT 3.1.1 broker standing in for EMQX in benchmarks.
+# Supports CONNECT, SUBSCRIBE/UNSUBSCRIBE (with + and # wildcards and $share/<group>/ filters),
+# PUBLISH at QoS 0/1, PINGREQ and DISCONNECT. No retained messages, wills or persistence.
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _string(value):
+    data = value.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def _packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+
+
+class _Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self.packet_ids = itertools.cycle(range(1, 65536))
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Broker:
+    def __init__(self, host="127.0.0.1", port=0, on_publish=None):
+        self.host = host
+        self.port = port
+        self.on_publish = on_publish
+        self.sessions = set()
+        self.messages_in = 0
+        self.messages_out = 0
+        self._share_cursor = itertools.count()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    # Run the broker on its own event loop thread; returns once it is listening
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        def shutdown():
+            self._server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+            # Let the transports finish closing so clients see the disconnect
+            self._loop.call_soon(self._loop.stop)
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join(5)
+
+    # Publish from outside the broker (e.g. a simulated mobile client)
+    def inject(self, topic, payload, qos=1):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._loop.call_soon_threadsafe(self._route, topic, payload, qos)
+
+    def subscribers(self, topic):
+        return sum(
+            1 for session in self.sessions
+            if any(topic_matches(self._strip_share(topic_filter)[1], topic) for topic_filter in session.subscriptions)
+        )
+
+    @staticmethod
+    def _strip_share(topic_filter):
+        if topic_filter.startswith("$share/"):
+            _, group, real_filter = topic_filter.split("/", 2)
+            return group, real_filter
+        return None, topic_filter
+
+    def _route(self, topic, payload, qos):
+        self.messages_in += 1
+        if self.on_publish is not None:
+            self.on_publish(topic, payload, time.perf_counter())
+        shared = {}
+        for session in self.sessions:
+            for topic_filter, granted in session.subscriptions.items():
+                group, real_filter = self._strip_share(topic_filter)
+                if not topic_matches(real_filter, topic):
+                    continue
+                if group is None:
+                    self._deliver(session, topic, payload, min(qos, granted))
+                else:
+                    shared.setdefault((group, real_filter), []).append((session, granted))
+                break
+        # Shared subscriptions deliver each message to one member of the group
+        for members in shared.values():
+            session, granted = members[next(self._share_cursor) % len(members)]
+            self._deliver(session, topic, payload, min(qos, granted))
+
+    def _deliver(self, session, topic, payload, qos):
+        body = _string(topic)
+        if qos:
+            body += struct.pack("!H", next(session.packet_ids))
+        session.send(_packet(PUBLISH, qos << 1, body + payload))
+        self.messages_out += 1
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def _handle(self, reader, writer):
+        session = _Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    name_length = struct.unpack_from("!H", body, 0)[0]
+                    offset = 2 + name_length + 4
+                    id_length = struct.unpack_from("!H", body, offset)[0]
+                    session.client_id = body[offset + 2:offset + 2 + id_length].decode("utf-8")
+                    session.send(_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack_from("!H", body, 0)[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        session.send(_packet(PUBACK, 0, packet_id))
+                    self._route(topic, body[offset:], min(qos, 1))
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        length = struct.unpack_from("!H", body, offset)[0]
+                        topic_filter = body[offset + 2:offset + 2 + length].decode("utf-8")
+                        qos = min(body[offset + 2 + length], 1)
+                        session.subscriptions[topic_filter] = qos
+                        granted.append(qos)
+                        offset += 3 + length
+                    session.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        length = struct.unpack_from("!H", body, offset)[0]
+                        session.subscriptions.pop(body[offset + 2:offset + 2 + length].decode("utf-8"), None)
+                        offset += 2 + length
+                    session.send(_packet(UNSUBACK, 0, packet_id))
+                elif packet_type == PINGREQ:
+                    session.send(_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                # PUBACKs from subscribers need no bookkeeping here
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
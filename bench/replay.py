@@ -0,0 +1,260 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Replay signals.log (or a recorded capture) through the server's decision logic.
+#
+#   python bench/replay.py signals.log                  # as fast as possible
+#   python bench/replay.py signals.log --speed 1        # original timing
+#   python bench/replay.py signals.log.1760000000000.123.gz --tail 120 --alerts
+#
+# Every MQTT line goes through Engine.on_message and every POST /diagnostics line through
+# the same parse + process_diagnostics path as do_POST, in one engine without network (no broker,
+# HTTP server or signals.log). Time is simulated: the clock jumps to each recorded timestamp, and alert timers due
+# in between fire at their own deadlines, so timeout and geofence alerts land where they
+# would have in production. Publishes go to an in-memory client; the report lists the alerts
+# that fired and the throughput of the decision logic.
+#
+# Input lines:
+#   <epoch> <topic>: <payload>                 signals.log
+#   <topic>: <payload>                         signals.log written before timestamps were added
+#                                              (spaced --gap seconds apart)
+#   {"time": <epoch>, "topic": "...", "payload": "..."}   NDJSON capture
+
+import db_writer
+from engine import Engine, Settings
+
+DIAGNOSTICS_SOURCE = "POST /diagnostics"
+ALERT_TOPIC = "esp32/alter/state"
+
+
+def open_log(path):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+# Yield (timestamp or None, source, payload) for every parseable line
+def read_events(lines):
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+                payload = record["payload"]
+                yield float(record["time"]), record["topic"], payload if isinstance(payload, str) else json.dumps(payload)
+            except (ValueError, KeyError, TypeError):
+                pass
+            continue
+        timestamp = None
+        head, _, rest = line.partition(" ")
+        try:
+            timestamp = float(head)
+            line = rest
+        except ValueError:
+            pass
+        source, separator, payload = line.partition(": ")
+        if separator:
+            yield timestamp, source, payload
+
+
+class SimulatedClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class _Result:
+    rc = 0
+
+
+# Stands in for the paho client: records publishes instead of sending them
+class ReplayClient:
+    def __init__(self, clock):
+        self.clock = clock
+        self.published = Counter()
+        self.alerts = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published[topic] += 1
+        if topic == ALERT_TOPIC:
+            try:
+                message = json.loads(payload)
+            except (TypeError, ValueError):
+                message = {}
+            if message.get("state") == "alert":
+                self.alerts.append((self.clock(), message.get("device_id"), message.get("reason")))
+        return _Result()
+
+
+class NullWriter:
+    def __init__(self, on_commit):
+        self.on_commit = on_commit
+
+    def write(self, row, durability=None, timeout=None):
+        self.on_commit(1, 0.0)
+
+    def depth(self):
+        return 0
+
+    def stop(self, timeout=5):
+        pass
+
+
+class Replay:
+    def __init__(self, speed=None, gap=1.0, tail=0.0, db_path=None, capacity=65536):
+        self.speed = speed
+        self.gap = gap
+        self.tail = tail
+        self.clock = SimulatedClock()
+        self.client = ReplayClient(self.clock)
+        self.counts = Counter()
+        self.timers_fired = 0
+        self.rows_stored = 0
+
+        settings = Settings.from_env(device_capacity=capacity)
+        if db_path:
+            settings = settings.replace(db_path=db_path)
+        self.engine = engine = Engine(settings, clock=self.clock, transport=self.client, network=False)
+        engine.publisher.start(background=False)
+        if db_path:
+            engine.init_db()
+            engine.statistics_writer = db_writer.StatisticsWriter(db_path, on_commit=self.count_rows)
+            engine.statistics_writer.start()
+        else:
+            engine.statistics_writer = NullWriter(self.count_rows)
+
+    # Fire every timer due up to `until`, each at its own deadline
+    def advance(self, until):
+        scheduler = self.engine.scheduler
+        while True:
+            deadline = scheduler.next_deadline()
+            if deadline is None or deadline > until:
+                break
+            self.clock.now = max(self.clock.now, deadline)
+            self.timers_fired += scheduler.run_due()
+        self.clock.now = max(self.clock.now, until)
+
+    def dispatch(self, source, payload):
+        engine = self.engine
+        if source == DIAGNOSTICS_SOURCE:
+            try:
+                readings = engine.parse_json_diagnostics(payload.encode("utf-8"))
+            except ValueError:
+                self.counts["invalid"] += 1
+                return
+            for reading in readings:
+                engine.process_diagnostics(reading)
+            self.counts["diagnostics"] += len(readings)
+        else:
+            message = SimpleNamespace(topic=source, payload=payload.encode("utf-8"))
+            engine.on_message(self.client, None, message)
+            self.counts["mqtt"] += 1
+
+    def run(self, events):
+        engine = self.engine
+        started = time.perf_counter()
+        first = last = None
+        for timestamp, source, payload in events:
+            if timestamp is None:
+                timestamp = (last if last is not None else time.time()) + self.gap
+            if first is None:
+                first = timestamp
+                self.clock.now = timestamp
+                engine.scheduler.arm("discovery", timestamp, engine.discover_devices)
+                engine.scheduler.arm("publish", timestamp + engine.publisher.window, self.flush_publisher)
+            if self.speed:
+                delay = started + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.advance(timestamp)
+            self.dispatch(source, payload)
+            last = max(last, timestamp) if last is not None else timestamp
+        if last is not None:
+            self.advance(last + self.tail)
+        engine.publisher.flush()
+        elapsed = time.perf_counter() - started
+        engine.close()
+        return self.report(first, last, elapsed)
+
+    # Rows that passed track compression (committed rows when --db is given)
+    def count_rows(self, rows, seconds):
+        self.rows_stored += rows
+
+    def flush_publisher(self, key, current_time):
+        self.engine.publisher.flush()
+        self.engine.scheduler.arm(key, current_time + self.engine.publisher.window, self.flush_publisher)
+
+    def report(self, first, last, elapsed):
+        events = self.counts["mqtt"] + self.counts["diagnostics"]
+        return {
+            "events": events,
+            "mqtt_messages": self.counts["mqtt"],
+            "diagnostics": self.counts["diagnostics"],
+            "invalid": self.counts["invalid"],
+            "recorded_seconds": (last - first) if first is not None else 0.0,
+            "replay_seconds": elapsed,
+            "events_per_second": events / elapsed if elapsed else float("nan"),
+            "timers_fired": self.timers_fired,
+            "rows_stored": self.rows_stored,
+            "alerts_by_reason": dict(Counter(reason for _, _, reason in self.client.alerts)),
+            "publishes_by_topic": dict(self.client.published),
+            "alerts": [
+                {"time": at, "device_id": device_id, "reason": reason}
+                for at, device_id, reason in self.client.alerts
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay signals.log or a recorded capture through the server's decision logic")
+    parser.add_argument("paths", nargs="+", help="signals.log files (plain or .gz), NDJSON captures, or - for stdin")
+    parser.add_argument("--speed", type=float, default=None, help="replay at N x the original timing (default: as fast as possible)")
+    parser.add_argument("--gap", type=float, default=1.0, help="seconds between lines that carry no timestamp")
+    parser.add_argument("--tail", type=float, default=0.0, help="simulated seconds to keep timers running after the last line")
+    parser.add_argument("--db", help="also store readings in this SQLite database (default: not stored)")
+    parser.add_argument("--alerts", action="store_true", help="list every alert that fired")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's INFO logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    def events():
+        for path in args.paths:
+            with open_log(path) as lines:
+                yield from read_events(lines)
+
+    report = Replay(speed=args.speed, gap=args.gap, tail=args.tail, db_path=args.db).run(events())
+    if not args.alerts:
+        report.pop("alerts")
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if key == "alerts":
+            print(f"{key:>22}:")
+            for alert in value:
+                print(f"{'':>24}{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(alert['time']))} "
+                      f"{alert['device_id']} {alert['reason']}")
+        else:
+            print(f"{key:>22}: {value:.2f}" if isinstance(value, float) else f"{key:>22}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import logging
+import sqlite3
+import time
+
+import db_writer
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 60 * 60
+DAY = 24 * 60 * 60
+
+# Per-device aggregates of statistics rows older than the raw retention window.
+# Every expired raw row is folded into both a minute and an hour bucket; minute buckets
+# expire after their own retention, hour buckets are kept (or expire if configured).
+ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS statistics_rollup (
+        client_id TEXT NOT NULL,
+        resolution INTEGER NOT NULL,
+        bucket REAL NOT NULL,
+        last_time REAL NOT NULL,
+        last_state TEXT,
+        last_reason TEXT,
+        last_lat REAL,
+        last_lon REAL,
+        last_battery TEXT,
+        min_battery REAL,
+        max_battery REAL,
+        min_lat REAL,
+        max_lat REAL,
+        min_lon REAL,
+        max_lon REAL,
+        samples INTEGER NOT NULL,
+        alert_samples INTEGER NOT NULL,
+        wire_samples INTEGER NOT NULL,
+        PRIMARY KEY (client_id, resolution, bucket)
+    )
+"""
+
+# Fold the raw rows of one chunk into rollups of a given resolution, merging with buckets
+# already written by earlier chunks. The last_* columns come from the newest row of each
+# bucket (newest = 1), picked explicitly since bare columns next to several aggregates are
+# taken from an arbitrary row.
+ROLLUP_CHUNK = """
+    INSERT INTO statistics_rollup (
+        client_id, resolution, bucket, last_time, last_state, last_reason, last_lat, last_lon,
+        last_battery, min_battery, max_battery, min_lat, max_lat, min_lon, max_lon, samples, alert_samples, wire_samples
+    )
+    SELECT
+        client_id, :resolution, rollup_bucket, MAX(time),
+        MAX(CASE WHEN newest = 1 THEN state END), MAX(CASE WHEN newest = 1 THEN reason END),
+        MAX(CASE WHEN newest = 1 THEN gps_lat END), MAX(CASE WHEN newest = 1 THEN gps_lon END),
+        MAX(CASE WHEN newest = 1 THEN battery_level END),
+        MIN(CASE WHEN battery_level GLOB '[0-9]*' THEN CAST(battery_level AS REAL) END),
+        MAX(CASE WHEN battery_level GLOB '[0-9]*' THEN CAST(battery_level AS REAL) END),
+        MIN(gps_lat), MAX(gps_lat), MIN(gps_lon), MAX(gps_lon),
+        COUNT(*), SUM(state = 'alert'), SUM(reason = 'wire')
+    FROM (
+        SELECT
+            client_id, time, state, reason, gps_lat, gps_lon, battery_level,
+            CAST(time / :resolution AS INTEGER) * :resolution AS rollup_bucket,
+            ROW_NUMBER() OVER (
+                PARTITION BY client_id, CAST(time / :resolution AS INTEGER) ORDER BY time DESC, id DESC
+            ) AS newest
+        FROM statistics
+        WHERE id <= :max_id AND time < :cutoff AND client_id IS NOT NULL
+    )
+    GROUP BY client_id, rollup_bucket
+    ON CONFLICT (client_id, resolution, bucket) DO UPDATE SET
+        last_state = CASE WHEN excluded.last_time >= last_time THEN excluded.last_state ELSE last_state END,
+        last_reason = CASE WHEN excluded.last_time >= last_time THEN excluded.last_reason ELSE last_reason END,
+        last_lat = CASE WHEN excluded.last_time >= last_time THEN excluded.last_lat ELSE last_lat END,
+        last_lon = CASE WHEN excluded.last_time >= last_time THEN excluded.last_lon ELSE last_lon END,
+        last_battery = CASE WHEN excluded.last_time >= last_time THEN excluded.last_battery ELSE last_battery END,
+        last_time = MAX(last_time, excluded.last_time),
+        min_battery = MIN(COALESCE(min_battery, excluded.min_battery), COALESCE(excluded.min_battery, min_battery)),
+        max_battery = MAX(COALESCE(max_battery, excluded.max_battery), COALESCE(excluded.max_battery, max_battery)),
+        min_lat = MIN(COALESCE(min_lat, excluded.min_lat), COALESCE(excluded.min_lat, min_lat)),
+        max_lat = MAX(COALESCE(max_lat, excluded.max_lat), COALESCE(excluded.max_lat, max_lat)),
+        min_lon = MIN(COALESCE(min_lon, excluded.min_lon), COALESCE(excluded.min_lon, min_lon)),
+        max_lon = MAX(COALESCE(max_lon, excluded.max_lon), COALESCE(excluded.max_lon, max_lon)),
+        samples = samples + excluded.samples,
+        alert_samples = alert_samples + excluded.alert_samples,
+        wire_samples = wire_samples + excluded.wire_samples
+"""
+
+
+# Incremental retention job. Each step() handles at most chunk_size rows in one short
+# transaction, so the SQLite write lock is only ever held briefly and the diagnostics
+# writer keeps committing in between. Raw rows are walked in id order from the head of
+# the table, which is where the oldest readings are.
+class Compactor:
+    def __init__(self, db_path, raw_retention_days=7, minute_retention_days=30, hour_retention_days=0,
+                 chunk_size=500, clock=time.time):
+        self.db_path = db_path
+        self.raw_retention = raw_retention_days * DAY
+        self.minute_retention = minute_retention_days * DAY
+        self.hour_retention = hour_retention_days * DAY
+        self.chunk_size = chunk_size
+        self.clock = clock
+        self.conn = None
+        self.rows_compacted = 0
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute(ROLLUP_SCHEMA)
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = db_writer.connect(self.db_path)
+        return self.conn
+
+    # Run one chunk; returns True while there is more work to do
+    def step(self):
+        try:
+            conn = self._connection()
+            now = self.clock()
+            if self._compact_raw(conn, now - self.raw_retention):
+                return True
+            if self._expire_rollups(conn, MINUTE, now - self.minute_retention):
+                return True
+            if self.hour_retention and self._expire_rollups(conn, HOUR, now - self.hour_retention):
+                return True
+            # Hand pages freed by the deletes back to the filesystem (no-op unless auto_vacuum is incremental)
+            conn.execute("PRAGMA incremental_vacuum(1000)")
+            return False
+        except sqlite3.Error as e:
+            logger.error(f"Statistics compaction failed: {e}")
+            return False
+
+    def _compact_raw(self, conn, cutoff):
+        row = conn.execute(
+            "SELECT id FROM statistics ORDER BY id LIMIT 1 OFFSET ?", (self.chunk_size - 1,)
+        ).fetchone()
+        max_id = row[0] if row else conn.execute("SELECT MAX(id) FROM statistics").fetchone()[0]
+        if max_id is None:
+            return False
+        params = {"max_id": max_id, "cutoff": cutoff}
+        with conn:
+            for resolution in (MINUTE, HOUR):
+                conn.execute(ROLLUP_CHUNK, dict(params, resolution=resolution))
+            deleted = conn.execute("DELETE FROM statistics WHERE id <= :max_id AND time < :cutoff", params).rowcount
+        self.rows_compacted += deleted
+        if deleted:
+            logger.debug(f"Compacted {deleted} statistics rows older than {cutoff:.0f}")
+        # Rows at the head of the table that are still inside the window stop this run
+        return deleted > 0 and row is not None
+
+    def _expire_rollups(self, conn, resolution, cutoff):
+        with conn:
+            deleted = conn.execute(
+                """
+                DELETE FROM statistics_rollup WHERE rowid IN (
+                    SELECT rowid FROM statistics_rollup
+                    WHERE resolution = ? AND bucket < ?
+                    LIMIT ?
+                )
+                """,
+                (resolution, cutoff - resolution, self.chunk_size)
+            ).rowcount
+        return deleted == self.chunk_size
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,150 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Durability modes for StatisticsWriter.write:
+#   async  - return once the row is queued; it is committed with the next batch
+#   commit - block until the batch holding the row has been committed
+DURABILITY_ASYNC = "async"
+DURABILITY_COMMIT = "commit"
+DURABILITY_MODES = (DURABILITY_ASYNC, DURABILITY_COMMIT)
+
+INSERT_STATISTICS = """
+    INSERT INTO statistics (time, state, gps_lat, gps_lon, battery_level, reason, client_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Keeps one row per device with its newest reading, so "latest per bike" never scans history
+UPSERT_LATEST_STATE = """
+    INSERT INTO latest_state (time, state, gps_lat, gps_lon, battery_level, reason, client_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(client_id) DO UPDATE SET
+        time = excluded.time,
+        state = excluded.state,
+        gps_lat = excluded.gps_lat,
+        gps_lon = excluded.gps_lon,
+        battery_level = excluded.battery_level,
+        reason = excluded.reason
+"""
+
+_STOP = object()
+
+
+# Open a connection with WAL enabled; synchronous=NORMAL is safe in WAL mode and
+# only risks the last commits on power loss, never corruption
+def connect(db_path, synchronous="NORMAL", check_same_thread=True):
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread)
+    # Must precede the first write of a new database; a no-op on existing ones.
+    # Lets retention compaction hand freed pages back with PRAGMA incremental_vacuum.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    return conn
+
+
+class _Pending:
+    __slots__ = ("row", "done", "error")
+
+    def __init__(self, row, wait):
+        self.row = row
+        self.done = threading.Event() if wait else None
+        self.error = None
+
+
+# Single writer thread with a persistent connection that group-commits queued rows:
+# one transaction per batch_size rows or per flush_interval seconds, whichever comes first.
+# Rows are (time, state, gps_lat, gps_lon, battery_level, reason, client_id).
+# on_commit(rows, seconds) is called after every successful batch.
+class StatisticsWriter:
+    def __init__(self, db_path, batch_size=100, flush_interval=0.05, queue_size=10000, synchronous="NORMAL",
+                 on_commit=None):
+        self.db_path = db_path
+        self.on_commit = on_commit
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.rows_written = 0
+        self.batches_written = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+        logger.info(f"Started SQLite writer (batch_size={self.batch_size}, flush_interval={self.flush_interval}s)")
+
+    # Queue one statistics row; with durability="commit" this waits for the commit and
+    # re-raises a failed commit as sqlite3.Error
+    def write(self, row, durability=DURABILITY_ASYNC, timeout=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        pending = _Pending(row, wait=durability == DURABILITY_COMMIT)
+        self.queue.put(pending, timeout=timeout)
+        if pending.done is not None:
+            if not pending.done.wait(timeout):
+                raise TimeoutError("Timed out waiting for statistics commit")
+            if pending.error is not None:
+                raise pending.error
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        conn = connect(self.db_path, self.synchronous)
+        try:
+            stopping = False
+            while not stopping:
+                item = self.queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        error = None
+        rows = [pending.row for pending in batch]
+        # Only the newest row of each device in the batch needs to reach latest_state
+        latest = {row[-1]: row for row in rows}
+        started = time.perf_counter()
+        try:
+            with conn:
+                conn.executemany(INSERT_STATISTICS, rows)
+                conn.executemany(UPSERT_LATEST_STATE, list(latest.values()))
+            self.rows_written += len(batch)
+            self.batches_written += 1
+            if self.on_commit is not None:
+                self.on_commit(len(batch), time.perf_counter() - started)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to store {len(batch)} diagnostics rows in database: {e}")
+            error = e
+        for pending in batch:
+            if pending.done is not None:
+                pending.error = error
+                pending.done.set()
+
+    # Flush what is queued and stop the writer thread
+    def stop(self, timeout=5):
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
@@ -0,0 +1,241 @@
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+
+# Fleet-wide per-device state kept in a shared memory record table.
+# The table is an open-addressing hash keyed by client_id (crc32 + linear probing),
+# so both the MQTT main process and the HTTP process can find a bike's record in O(1)
+# and read/write single fields with struct.pack_into, without pickling anything.
+# Every change of a device's state bumps its version and wakes wait_for_change() callers.
+# create(shared=False) keeps the same table in process memory with thread locks, for engines
+# that never hand the registry to another process (replays, simulations).
+
+STATES = ("unknown", "lock", "unlock", "alert")
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+KEY_SIZE = 64
+BATTERY_SIZE = 16
+
+# Header: capacity, number of used slots, epoch (creation time, so versions from an
+# earlier table are never mistaken for current ones)
+HEADER = struct.Struct("<III")
+
+# Float fields use NaN to mean "not set" (None)
+FLOAT_FIELDS = (
+    "last_diagnostic_time",
+    "gps_lat",
+    "gps_lon",
+    "reference_gps_lat",
+    "reference_gps_lon",
+    "last_alert_time",
+    "last_distance_alert_time",
+    "last_wire_alert_time",
+)
+
+RECORD = struct.Struct(f"<{KEY_SIZE}sBBxxI{len(FLOAT_FIELDS)}d{BATTERY_SIZE}s")
+
+# Byte offset of each field inside a record, so single fields can be updated in place
+FIELD_OFFSETS = {"state": KEY_SIZE, "timeout_status": KEY_SIZE + 1}
+for _i, _name in enumerate(FLOAT_FIELDS):
+    FIELD_OFFSETS[_name] = KEY_SIZE + 8 + 8 * _i
+FIELD_OFFSETS["battery_level"] = KEY_SIZE + 8 + 8 * len(FLOAT_FIELDS)
+_VERSION_OFFSET = KEY_SIZE + 4
+
+_DOUBLE = struct.Struct("<d")
+_BYTE = struct.Struct("<B")
+_UINT = struct.Struct("<I")
+_BATTERY = struct.Struct(f"<{BATTERY_SIZE}s")
+
+
+def _to_float(value):
+    if value is None:
+        return math.nan
+    return float(value)
+
+
+def _from_float(value):
+    return None if math.isnan(value) else value
+
+
+# Stands in for SharedMemory when the table stays in one process
+class _LocalMemory:
+    name = None
+
+    def __init__(self, size):
+        # Anonymous mapping: zeroed like shared memory, pages allocated on first write
+        self._map = mmap.mmap(-1, size)
+        self.buf = memoryview(self._map)
+
+    def close(self):
+        self.buf = None
+
+    def unlink(self):
+        pass
+
+
+# Record of a freshly claimed slot: no state, version 0, every float field unset
+_EMPTY_FIELDS = (0, 0, 0, *([math.nan] * len(FLOAT_FIELDS)), b"")
+
+
+class DeviceRegistry:
+    def __init__(self, shm, lock, changed, owner=False):
+        self._shm = shm
+        self._buf = shm.buf
+        self._lock = lock
+        self._changed = changed
+        self._owner = owner
+        self.capacity, _, self.epoch = HEADER.unpack_from(self._buf, 0)
+        self._mask = self.capacity - 1
+
+    # Allocate a new table; capacity is rounded up to a power of two. Slots start zeroed (empty
+    # key) and get their full record when claimed, so pages of unused slots are never touched.
+    @classmethod
+    def create(cls, capacity=4096, shared=True):
+        capacity = 1 << max(0, int(capacity) - 1).bit_length()
+        size = HEADER.size + capacity * RECORD.size
+        if shared:
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            lock, changed = multiprocessing.Lock(), multiprocessing.Condition()
+        else:
+            shm = _LocalMemory(size)
+            lock, changed = threading.Lock(), threading.Condition()
+        HEADER.pack_into(shm.buf, 0, capacity, 0, int(time.time()))
+        return cls(shm, lock, changed, owner=True)
+
+    # Processes receive the registry by shared memory name and re-attach to the same table
+    def __getstate__(self):
+        if self._shm.name is None:
+            raise TypeError("An in-process device registry cannot be passed to another process")
+        return {"name": self._shm.name, "lock": self._lock, "changed": self._changed}
+
+    def __setstate__(self, state):
+        self.__init__(shared_memory.SharedMemory(name=state["name"]), state["lock"], state["changed"])
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+    @staticmethod
+    def _encode_key(client_id):
+        key = str(client_id).encode("utf-8")
+        if not key or len(key) > KEY_SIZE:
+            raise ValueError(f"client_id must be 1-{KEY_SIZE} bytes: {client_id!r}")
+        return key
+
+    # Find the slot for a key; returns -1 when absent and create is False
+    def _find(self, key, create):
+        slot = zlib.crc32(key) & self._mask
+        for _ in range(self.capacity):
+            offset = self._offset(slot)
+            stored = bytes(self._buf[offset:offset + KEY_SIZE]).rstrip(b"\x00")
+            if stored == key:
+                return slot
+            if not stored:
+                if not create:
+                    return -1
+                RECORD.pack_into(self._buf, offset, key, *_EMPTY_FIELDS)
+                capacity, count, epoch = HEADER.unpack_from(self._buf, 0)
+                HEADER.pack_into(self._buf, 0, capacity, count + 1, epoch)
+                return slot
+            slot = (slot + 1) & self._mask
+        raise RuntimeError(f"Device registry is full ({self.capacity} devices)")
+
+    def _read(self, slot):
+        values = RECORD.unpack_from(self._buf, self._offset(slot))
+        record = {
+            "client_id": values[0].rstrip(b"\x00").decode("utf-8"),
+            "state": STATES[values[1]],
+            "timeout_status": bool(values[2]),
+            "version": values[3],
+        }
+        for name, value in zip(FLOAT_FIELDS, values[4:4 + len(FLOAT_FIELDS)]):
+            record[name] = _from_float(value)
+        battery = values[-1].rstrip(b"\x00").decode("utf-8", "replace")
+        record["battery_level"] = battery or None
+        return record
+
+    # Returns True when the device's state changed
+    def _write(self, slot, fields):
+        base = self._offset(slot)
+        changed = False
+        for name, value in fields.items():
+            offset = base + FIELD_OFFSETS[name]
+            if name == "state":
+                code = STATE_CODES.get(value, 0)
+                if self._buf[offset] != code:
+                    _BYTE.pack_into(self._buf, offset, code)
+                    version = _UINT.unpack_from(self._buf, base + _VERSION_OFFSET)[0]
+                    _UINT.pack_into(self._buf, base + _VERSION_OFFSET, (version + 1) & 0xFFFFFFFF)
+                    changed = True
+            elif name == "timeout_status":
+                _BYTE.pack_into(self._buf, offset, 1 if value else 0)
+            elif name == "battery_level":
+                battery = b"" if value is None else str(value).encode("utf-8")[:BATTERY_SIZE]
+                _BATTERY.pack_into(self._buf, offset, battery)
+            else:
+                _DOUBLE.pack_into(self._buf, offset, _to_float(value))
+        return changed
+
+    # Slot index of a device (stable for the lifetime of the table), or -1 if unknown
+    def slot(self, client_id):
+        key = self._encode_key(client_id)
+        with self._lock:
+            return self._find(key, create=False)
+
+    # Raw record table for vectorized readers; record i starts at i * RECORD.size
+    @property
+    def records(self):
+        return self._buf[HEADER.size:]
+
+    def get(self, client_id):
+        key = self._encode_key(client_id)
+        with self._lock:
+            slot = self._find(key, create=False)
+            return self._read(slot) if slot >= 0 else None
+
+    # Set one or more fields on a device, registering it on first use
+    def update(self, client_id, **fields):
+        unknown = set(fields) - set(FIELD_OFFSETS)
+        if unknown:
+            raise KeyError(f"Unknown device fields: {', '.join(sorted(unknown))}")
+        key = self._encode_key(client_id)
+        with self._lock:
+            slot = self._find(key, create=True)
+            changed = self._write(slot, fields)
+        if changed:
+            with self._changed:
+                self._changed.notify_all()
+
+    # Block until the device's version differs from `version` or the timeout expires;
+    # returns the latest record (None if the device is still unknown)
+    def wait_for_change(self, client_id, version, timeout):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                record = self.get(client_id)
+                current = record["version"] if record else 0
+                remaining = deadline - time.monotonic()
+                if current != version or remaining <= 0:
+                    return record
+                self._changed.wait(remaining)
+
+    def devices(self):
+        with self._lock:
+            records = []
+            for slot in range(self.capacity):
+                if self._buf[self._offset(slot)] != 0:
+                    records.append(self._read(slot))
+            return records
+
+    def __len__(self):
+        return HEADER.unpack_from(self._buf, 0)[1]
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,1445 @@
+import os
+import math
+import ssl
+import logging
+import random
+import json
+from http.server import BaseHTTPRequestHandler
+import time
+import signal
+import sys
+import threading
+from multiprocessing import Process
+from multiprocessing.connection import wait as wait_for_processes
+import sqlite3
+from urllib.parse import urlparse, parse_qs
+from device_registry import DeviceRegistry, STATES
+from ingest import PooledHTTPServer, WorkerPool
+import db_writer
+from scheduler import DeadlineScheduler
+from geofence import FleetGeofence
+from log_sink import SignalLog
+import frames
+from metrics import Metrics
+from history import stream_history
+from compaction import Compactor
+import zones
+from sharding import HashRing, ShardRouter, shard_db_path, shard_request_topic
+from publisher import Publisher, parse_qos, serialize
+from outbox import Outbox, PRIORITY_ALERT, PRIORITY_STATE
+from track import TrackCompressor
+from admission import Admission
+
+logger = logging.getLogger(__name__)
+
+# The BantayBike server as an importable engine. Nothing here touches the network, the disk or
+# the environment at import time: an Engine is built from Settings (Settings.from_env() reads
+# the same variables test_server.py always did) plus an injectable clock and MQTT transport.
+#
+#   Engine(settings).run()                            # the server: MQTT loop, HTTP process, SQLite
+#   Engine(settings, clock=sim, transport=recorder, network=False)
+#                                                     # decision logic only, for replays/simulations
+#
+# The paho client (and its TLS context) is only created when run() connects.
+
+# Topics the server subscribes to and publishes on
+SUBSCRIBE_TOPICS = [
+    "server/request/mobile",
+    "server/test"
+]
+PUBLISH_TOPICS = [
+    "esp32/data",
+    "esp32/alter/state",
+    "esp32/alter/mode",
+    "esp32/alter/gps",
+    "mobile/statistics"
+]
+
+# paho.mqtt.client.MQTT_ERR_SUCCESS, without importing paho for engines that never connect
+MQTT_ERR_SUCCESS = 0
+
+FIRST_RECONNECT_DELAY = 1
+RECONNECT_RATE = 2
+MAX_RECONNECT_DELAY = 60
+
+# Alert timing (seconds) and geofence radius (meters)
+DIAGNOSTICS_TIMEOUT = 30
+ALERT_REPEAT_INTERVAL = 30
+WIRE_ALERT_COOLDOWN = 5
+GEOFENCE_RADIUS = 10
+DEVICE_DISCOVERY_INTERVAL = 1
+MAX_LOOP_WAIT = 1.0
+
+# /history defaults: range (seconds) when 'from' is omitted, points per response, NDJSON lines per chunk
+HISTORY_DEFAULT_RANGE = 24 * 60 * 60
+HISTORY_MAX_POINTS = 500
+HISTORY_POINTS_LIMIT = 5000
+HISTORY_CHUNK_LINES = 64
+
+# Binary frame readings are logged to signals.log in the JSON diagnostics shape
+FRAME_LOG_FIELDS = ("state", "client_id", "battery_level", "gps_lat", "gps_lon", "reason")
+
+# /commands responses only depend on the state, so they are serialized once
+COMMAND_BODIES = {
+    state: json.dumps({"state": state, "client_id": "server", "reason": "null"}).encode('utf-8')
+    for state in STATES
+}
+
+SIGNALS_LOG = "signals.log"
+COMPACTION_CHUNK_PAUSE = 0.05
+
+STATISTICS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS statistics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        time REAL NOT NULL,
+        state TEXT NOT NULL,
+        gps_lat REAL,
+        gps_lon REAL,
+        battery_level TEXT,
+        reason TEXT,
+        client_id TEXT
+    )
+"""
+
+# -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+# Server configuration. Class attributes are the defaults; Settings(name=value, ...) overrides
+# them and Settings.from_env() reads the environment variables listed in ENVIRONMENT.
+class Settings:
+    # EMQX Serverless settings (client_id None = random per run)
+    broker = None
+    port = 8883
+    command_topic = "esp32/command"
+    username = None
+    password = None
+    client_id = None
+    ca_cert = os.path.join(os.path.dirname(__file__), "emqxsl-ca.crt")
+    # TLS can be turned off for a local broker (benchmarks, development)
+    use_tls = True
+
+    # Outbound publishes: per-device data/"updated" messages are coalesced to one per
+    # publish_window_ms, unchanged data/statistics payloads are skipped for up to
+    # publish_repeat_seconds, and mqtt_qos ({topic: qos}) overrides the default QoS 1 per topic
+    publish_window_ms = 500
+    publish_repeat_seconds = 60.0
+    mqtt_qos = {}
+
+    # Alerts and lock/unlock state messages published while the broker is unreachable wait in a
+    # per-process SQLite outbox next to db_path (at most outbox_max_messages, oldest non-alerts
+    # dropped first) and are sent once the connection is back, alerts first
+    outbox_max_messages = 10000
+
+    # Fleet settings
+    device_capacity = 4096
+    default_device_id = "ESP32"
+    geofence_interval = 1.0
+
+    # Named zones per bike (see zones.py): grid cell size of the spatial index (degrees) and how
+    # often the main process checks the zones table for changes (seconds)
+    zones_grid_degrees = 0.01
+    zones_reload_interval = 10.0
+
+    # Public HTTP listener
+    http_host = "0.0.0.0"
+    http_port = 8080
+
+    # Sharding: with shards > 1 the server runs that many shard processes, each owning a
+    # consistent-hash slice of client_ids with its own MQTT loop, HTTP ingest process, registry,
+    # SQLite file and alert timers. An HTTP router on http_port forwards to the owning shard on
+    # 127.0.0.1:shard_port_base+n; MQTT requests are spread with $share/mqtt_share_group/...
+    # shard_index is set for the engine of one shard only.
+    shards = 1
+    shard_port_base = 9100
+    mqtt_share_group = "bantaybike"
+    shard_index = None
+
+    # HTTP ingest settings: connection handler threads, persistence/publish workers and their queue bound
+    http_workers = 16
+    ingest_workers = 4
+    ingest_queue_size = 1024
+
+    # /diagnostics admission control: each client_id may post diagnostics_rate requests per
+    # second with bursts of diagnostics_burst (0 = unlimited); refused requests get 429 and only
+    # their latest reading is kept for later (see admission.py). Once the ingest queue is
+    # ingest_high_water full, other readings get 503. Both carry Retry-After (ingest_retry_after
+    # seconds for 503). One wire alert per device every WIRE_ALERT_COOLDOWN seconds bypasses
+    # both limits; further wire posts within the cooldown are treated like any other request.
+    diagnostics_rate = 1.0
+    diagnostics_burst = 10
+    ingest_high_water = 0.8
+    ingest_retry_after = 1
+
+    # /commands long-poll: longest hold (seconds) and how many handler threads may be held at
+    # once (None = half of http_workers)
+    commands_max_wait = 55.0
+    commands_long_polls = None
+
+    # SQLite database
+    db_path = os.path.join(os.path.dirname(__file__), "bantaybike.db")
+
+    # signals.log sink: rotate by size (bytes) and/or age (seconds, 0 = off), keeping
+    # signals_log_backups gzip segments
+    signals_log_max_bytes = 5 * 1024 * 1024
+    signals_log_rotate_seconds = 0
+    signals_log_backups = 5
+
+    # Group commit settings for the diagnostics writer; db_durability is "async" or "commit"
+    db_batch_size = 100
+    db_flush_ms = 50
+    db_durability = db_writer.DURABILITY_ASYNC
+
+    # Retention: raw statistics rows are kept statistics_raw_days, then rolled up into per-device
+    # minute and hour aggregates; minute rollups are kept statistics_minute_days, hour rollups
+    # statistics_hour_days (0 = forever). Compaction runs every compaction_interval seconds in
+    # chunks of compaction_chunk_rows rows, yielding to the main loop between chunks.
+    statistics_raw_days = 7.0
+    statistics_minute_days = 30.0
+    statistics_hour_days = 0.0
+    compaction_interval = 600.0
+    compaction_chunk_rows = 500
+
+    # Track compression: a reading is only stored when its position moved more than
+    # track_tolerance_meters from the last stored one, its state/reason/battery changed, or
+    # track_heartbeat_seconds passed since the last stored reading (0 meters stores every reading)
+    track_tolerance_meters = 10.0
+    track_heartbeat_seconds = 60.0
+
+    def __init__(self, **overrides):
+        for name, value in overrides.items():
+            if name.startswith("_") or not hasattr(Settings, name) or callable(getattr(Settings, name)):
+                raise TypeError(f"Unknown setting: {name}")
+            setattr(self, name, value)
+
+    @classmethod
+    def from_env(cls, environ=None, **overrides):
+        environ = os.environ if environ is None else environ
+        values = {name: parse(environ[variable]) for variable, (name, parse) in ENVIRONMENT.items() if variable in environ}
+        values.update(overrides)
+        return cls(**values)
+
+    # Copy with some settings changed
+    def replace(self, **overrides):
+        return Settings(**{**vars(self), **overrides})
+
+    def long_polls(self):
+        return self.commands_long_polls or max(1, self.http_workers // 2)
+
+# Environment variable -> (setting, parser)
+ENVIRONMENT = {
+    "EMQX_BROKER": ("broker", str),
+    "EMQX_PORT": ("port", int),
+    "EMQX_COMMAND_TOPIC": ("command_topic", str),
+    "EMQX_USERNAME": ("username", str),
+    "EMQX_PASSWORD": ("password", str),
+    "EMQX_CA_CERT": ("ca_cert", lambda value: os.path.join(os.path.dirname(__file__), value)),
+    "EMQX_TLS": ("use_tls", lambda value: value != "0"),
+    "PUBLISH_WINDOW_MS": ("publish_window_ms", int),
+    "PUBLISH_REPEAT_SECONDS": ("publish_repeat_seconds", float),
+    "MQTT_QOS": ("mqtt_qos", parse_qos),
+    "OUTBOX_MAX_MESSAGES": ("outbox_max_messages", int),
+    "DEVICE_CAPACITY": ("device_capacity", int),
+    "DEFAULT_DEVICE_ID": ("default_device_id", str),
+    "GEOFENCE_INTERVAL": ("geofence_interval", float),
+    "ZONES_GRID_DEGREES": ("zones_grid_degrees", float),
+    "ZONES_RELOAD_INTERVAL": ("zones_reload_interval", float),
+    "PORT": ("http_port", int),
+    "SHARDS": ("shards", int),
+    "SHARD_PORT_BASE": ("shard_port_base", int),
+    "MQTT_SHARE_GROUP": ("mqtt_share_group", str),
+    "HTTP_WORKERS": ("http_workers", int),
+    "INGEST_WORKERS": ("ingest_workers", int),
+    "INGEST_QUEUE_SIZE": ("ingest_queue_size", int),
+    "DIAGNOSTICS_RATE": ("diagnostics_rate", float),
+    "DIAGNOSTICS_BURST": ("diagnostics_burst", float),
+    "INGEST_HIGH_WATER": ("ingest_high_water", float),
+    "INGEST_RETRY_AFTER": ("ingest_retry_after", int),
+    "COMMANDS_MAX_WAIT": ("commands_max_wait", float),
+    "COMMANDS_LONG_POLLS": ("commands_long_polls", int),
+    "DB_PATH": ("db_path", str),
+    "SIGNALS_LOG_MAX_BYTES": ("signals_log_max_bytes", int),
+    "SIGNALS_LOG_ROTATE_SECONDS": ("signals_log_rotate_seconds", int),
+    "SIGNALS_LOG_BACKUPS": ("signals_log_backups", int),
+    "DB_BATCH_SIZE": ("db_batch_size", int),
+    "DB_FLUSH_MS": ("db_flush_ms", int),
+    "DB_DURABILITY": ("db_durability", str),
+    "STATISTICS_RAW_DAYS": ("statistics_raw_days", float),
+    "STATISTICS_MINUTE_DAYS": ("statistics_minute_days", float),
+    "STATISTICS_HOUR_DAYS": ("statistics_hour_days", float),
+    "COMPACTION_INTERVAL": ("compaction_interval", float),
+    "COMPACTION_CHUNK_ROWS": ("compaction_chunk_rows", int),
+    "TRACK_TOLERANCE_METERS": ("track_tolerance_meters", float),
+    "TRACK_HEARTBEAT_SECONDS": ("track_heartbeat_seconds", float),
+}
+
+# Stands in for the MQTT client of an engine without network: every publish succeeds
+class NullTransport:
+    class _Result:
+        rc = MQTT_ERR_SUCCESS
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self._Result()
+
+    def is_connected(self):
+        return True
+
+    def socket(self):
+        return None
+
+# -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+class Engine:
+    # settings: Settings (defaults when None); broker/db_path override the matching settings.
+    # clock: time source of the decision logic (diagnostics times, alert timers).
+    # transport: object with the paho publish() interface used instead of a paho client.
+    # network=False: no broker, HTTP server or files; the registry is created here in process
+    # memory and publishes go to the transport (NullTransport by default).
+    def __init__(self, settings=None, clock=time.time, transport=None, broker=None, db_path=None,
+                 network=True, registry=None):
+        settings = settings or Settings()
+        overrides = {"client_id": settings.client_id or f"python-mqtt-server-{random.randint(0, 1000)}"}
+        if broker is not None:
+            overrides["broker"] = broker
+        if db_path is not None:
+            overrides["db_path"] = db_path
+        self.settings = settings.replace(**overrides)
+        self.clock = clock
+        # Interval timing (publish repeats, rate limits) follows the monotonic clock unless a
+        # clock is injected
+        self.monotonic = time.monotonic if clock is time.time else clock
+        self.network = network
+        self.client = transport if transport is not None or network else NullTransport()
+        self.shard_index = self.settings.shard_index
+        self.shard_ring = HashRing(self.settings.shards) if self.shard_index is not None else None
+
+        # Set to stop the main loop; also tells on_disconnect not to reconnect
+        self.intentional_disconnect = False
+        self.http_process = None
+        self.initial_connection_complete = False
+        # Backoff before the next reconnect attempt, reset on every successful connect
+        self.reconnect_delay = FIRST_RECONNECT_DELAY
+
+        # Per-device state (state, last diagnostics, reference GPS, alert times) shared with the HTTP process
+        # (created by run() or, without network, here; an injected registry is left open by close())
+        self.owns_registry = registry is None
+        self.registry = registry if registry is not None or network else DeviceRegistry.create(self.settings.device_capacity, shared=False)
+
+        # Diagnostics persistence/publish workers and per-device admission (HTTP process only)
+        self.ingest_pool = None
+        self.admission = None
+        self.long_poll_slots = threading.BoundedSemaphore(self.settings.long_polls())
+
+        # Alert timers for the main loop
+        self.scheduler = DeadlineScheduler(clock=clock)
+        self.fleet_geofence = FleetGeofence()
+        self.zone_geofence = zones.ZoneGeofence(zones.ZoneIndex(self.settings.zones_grid_degrees))
+        self.zones_loaded_version = None
+        self.known_device_count = 0
+
+        self.compactor = None
+        self.track = TrackCompressor(
+            tolerance=self.settings.track_tolerance_meters,
+            heartbeat=self.settings.track_heartbeat_seconds
+        )
+
+        # Persistent connections: the writer lives in the HTTP process, the reader in the MQTT
+        # process; HTTP handler threads (/history, /zones) get one connection each
+        self.statistics_writer = None
+        self.stats_conn = None
+        self.http_connections = threading.local()
+
+        # Background signals.log writer and durable outbound queue, one per process (None
+        # without network)
+        self.signal_log = None
+        self.outbox = None
+
+        self.declare_metrics()
+
+        # Change suppression and per-device coalescing in front of publish_message (see publisher.py)
+        self.publisher = Publisher(
+            lambda topic, payload, qos: self.publish_message(self.client, topic, payload, qos),
+            window=self.settings.publish_window_ms / 1000,
+            qos=self.settings.mqtt_qos,
+            repeat_interval=self.settings.publish_repeat_seconds,
+            clock=self.monotonic
+        )
+        self.publisher.on_suppressed = self.publish_suppressed.inc
+        self.publisher.on_coalesced = self.publish_coalesced.inc
+
+    # Hot-path metrics served on /metrics (allocated in run() before the HTTP process starts;
+    # until then recording is a no-op)
+    def declare_metrics(self):
+        metrics = self.metrics = Metrics()
+        self.parse_seconds = metrics.histogram("bantaybike_diagnostics_parse_seconds", "Time to parse a POST /diagnostics body")
+        self.db_insert_seconds = metrics.histogram("bantaybike_db_insert_seconds", "Time to insert and commit one batch of statistics rows")
+        self.db_rows = metrics.counter("bantaybike_db_rows_total", "Statistics rows committed")
+        self.publish_seconds = metrics.histogram("bantaybike_publish_seconds", "Time spent in client.publish", "topic", PUBLISH_TOPICS)
+        self.publish_failures = metrics.counter("bantaybike_mqtt_publish_failures_total", "MQTT publishes that failed", "topic", PUBLISH_TOPICS)
+        self.alerts = metrics.counter("bantaybike_alerts_total", "Alerts published", "reason", ("wire", "gps", "timeout"))
+        self.mqtt_reconnects = metrics.counter("bantaybike_mqtt_reconnects_total", "Successful MQTT reconnects")
+        self.publish_suppressed = metrics.counter("bantaybike_publish_suppressed_total", "Publishes skipped because the payload was unchanged", "topic", PUBLISH_TOPICS)
+        self.publish_coalesced = metrics.counter("bantaybike_publish_coalesced_total", "Queued publishes replaced by a newer one in the same window", "topic", PUBLISH_TOPICS)
+        self.outbox_queued = metrics.counter("bantaybike_outbox_queued_total", "Messages stored in the outbox while the broker was unreachable")
+        self.outbox_delivered = metrics.counter("bantaybike_outbox_delivered_total", "Outbox messages handed to the MQTT client after reconnecting")
+        self.outbox_dropped = metrics.counter("bantaybike_outbox_dropped_total", "Outbox messages dropped because the outbox was full")
+        self.track_skipped = metrics.counter("bantaybike_track_readings_skipped_total", "Diagnostics readings not stored because they added no information to the track")
+        self.diagnostics_rejected = metrics.counter("bantaybike_diagnostics_rejected_total", "Diagnostics readings rejected because the ingest queue was full or above its high-water mark")
+        self.diagnostics_rate_limited = metrics.counter("bantaybike_diagnostics_rate_limited_total", "POST /diagnostics requests refused by the per-device rate limit")
+        self.diagnostics_collapsed = metrics.counter("bantaybike_diagnostics_collapsed_total", "Rate-limited diagnostics readings dropped in favor of a newer one from the same device")
+        metrics.gauge("bantaybike_active_devices", "Devices that sent diagnostics within the timeout window", self.count_active_devices)
+        metrics.gauge("bantaybike_registered_devices", "Devices in the state registry", lambda: len(self.registry))
+        metrics.gauge("bantaybike_db_queue_depth", "Rows waiting for the SQLite writer", lambda: self.statistics_writer.depth() if self.statistics_writer else None)
+        metrics.gauge("bantaybike_publish_pending", "Devices with coalesced publishes waiting for the window", lambda: self.publisher.depth())
+        metrics.gauge("bantaybike_ingest_queue_depth", "Readings waiting for an ingest worker", lambda: self.ingest_pool.depth() if self.ingest_pool else None)
+        metrics.gauge("bantaybike_diagnostics_deferred", "Devices with a rate-limited reading waiting for a token", lambda: self.admission.depth() if self.admission else None)
+
+    def count_active_devices(self):
+        current_time = self.clock()
+        return sum(
+            1 for device in self.registry.devices()
+            if device["last_diagnostic_time"] is not None and current_time - device["last_diagnostic_time"] <= DIAGNOSTICS_TIMEOUT
+        )
+
+    def http_connection(self):
+        conn = getattr(self.http_connections, "conn", None)
+        if conn is None:
+            conn = self.http_connections.conn = db_writer.connect(self.settings.db_path)
+        return conn
+
+    # signals.log lines are "<epoch> <source>: <payload>" so recordings can be replayed with their timing
+    def log_signal(self, source, payload):
+        if self.signal_log is not None:
+            self.signal_log.write(f"{self.clock():.3f} {source}: {payload}\n")
+
+    def create_signal_log(self):
+        sink = SignalLog(
+            SIGNALS_LOG,
+            max_bytes=self.settings.signals_log_max_bytes,
+            rotate_interval=self.settings.signals_log_rotate_seconds,
+            backups=self.settings.signals_log_backups
+        )
+        sink.start()
+        return sink
+
+    # bantaybike.db -> bantaybike.outbox-main.db / bantaybike.outbox-http.db
+    def create_outbox(self, role):
+        root, ext = os.path.splitext(self.settings.db_path)
+        box = Outbox(f"{root}.outbox-{role}{ext}", max_messages=self.settings.outbox_max_messages)
+        box.on_dropped = self.outbox_dropped.inc
+        box.on_delivered = lambda count: self.outbox_delivered.inc(amount=count)
+        box.start(self.send_queued)
+        return box
+
+    # Older databases stored statistics.time as local "%Y-%m-%d %H:%M:%S" text; convert it to a
+    # numeric UTC epoch so range scans on (client_id, time) compare numbers
+    @staticmethod
+    def migrate_statistics_time(cursor):
+        columns = {row[1]: row[2] for row in cursor.execute("PRAGMA table_info(statistics)")}
+        if columns.get("time", "REAL").upper() != "TEXT":
+            return
+        logger.info("Migrating statistics.time from TEXT to epoch seconds")
+        cursor.execute("DROP INDEX IF EXISTS idx_statistics_client_time")
+        cursor.execute("ALTER TABLE statistics RENAME TO statistics_text_time")
+        cursor.execute(STATISTICS_SCHEMA)
+        cursor.execute("""
+            INSERT INTO statistics (id, time, state, gps_lat, gps_lon, battery_level, reason, client_id)
+            SELECT id, CAST(strftime('%s', time, 'utc') AS REAL), state, gps_lat, gps_lon, battery_level, reason, client_id
+            FROM statistics_text_time
+        """)
+        cursor.execute("DROP TABLE statistics_text_time")
+        # latest_state is derived data; it is rebuilt from statistics below
+        cursor.execute("DROP TABLE IF EXISTS latest_state")
+
+    def init_db(self):
+        conn = db_writer.connect(self.settings.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(STATISTICS_SCHEMA)
+            self.migrate_statistics_time(cursor)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_statistics_client_time
+                ON statistics (client_id, time)
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS latest_state (
+                    client_id TEXT PRIMARY KEY,
+                    time REAL NOT NULL,
+                    state TEXT NOT NULL,
+                    gps_lat REAL,
+                    gps_lon REAL,
+                    battery_level TEXT,
+                    reason TEXT
+                )
+            """)
+            Compactor.init_schema(cursor)
+            zones.init_schema(cursor)
+            # Backfill devices that only have rows from before latest_state existed
+            cursor.execute("""
+                INSERT OR IGNORE INTO latest_state (client_id, time, state, gps_lat, gps_lon, battery_level, reason)
+                SELECT client_id, time, state, gps_lat, gps_lon, battery_level, reason
+                FROM statistics
+                WHERE id IN (SELECT MAX(id) FROM statistics WHERE client_id IS NOT NULL GROUP BY client_id)
+            """)
+            conn.commit()
+            logger.info(f"Initialized SQLite database at {self.settings.db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to initialize SQLite database: {e}")
+            raise
+        finally:
+            conn.close()
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # MQTT Callbacks
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info("Connected to MQTT Broker!")
+            if self.initial_connection_complete:
+                self.mqtt_reconnects.inc()
+            self.initial_connection_complete = True
+            self.reconnect_delay = FIRST_RECONNECT_DELAY
+            if self.outbox is not None:
+                self.outbox.notify()
+            # The HTTP ingest process only publishes, so its client skips the subscriptions
+            if userdata and not userdata.get("subscribe", True):
+                return
+            for topic in self.subscription_topics():
+                client.subscribe(topic, qos=1)
+                logger.info(f"Subscribed to {topic}")
+        else:
+            logger.error(f"Connection failed with code {rc}")
+
+    # Shards share the request topics (the broker hands each message to one of them) and also
+    # listen on their own topic for requests forwarded by the other shards
+    def subscription_topics(self):
+        if self.shard_index is None:
+            return SUBSCRIBE_TOPICS
+        return [f"$share/{self.settings.mqtt_share_group}/{topic}" for topic in SUBSCRIBE_TOPICS] + [shard_request_topic(self.shard_index)]
+
+    # Re-publish a mobile request to the shard that owns its device; False if it is ours
+    def forward_to_owner(self, client, payload):
+        try:
+            device_id = json.loads(payload).get("device_id") or self.settings.default_device_id
+        except (ValueError, AttributeError):
+            return False
+        owner = self.shard_ring.owner(device_id)
+        if owner == self.shard_index:
+            return False
+        result = client.publish(shard_request_topic(owner), payload, qos=1)
+        if result.rc != MQTT_ERR_SUCCESS:
+            logger.error(f"Failed to forward request for {device_id} to shard {owner}")
+        return True
+
+    def on_message(self, client, userdata, msg):
+        registry = self.registry
+        try:
+            payload = msg.payload.decode('utf-8')
+            topic = msg.topic
+            if self.shard_index is not None:
+                if topic == shard_request_topic(self.shard_index):
+                    topic = "server/request/mobile"
+                elif topic == "server/request/mobile" and self.forward_to_owner(client, payload):
+                    return
+            logger.debug(f"Received: {payload} on topic {topic}")
+            self.log_signal(topic, payload)
+
+            data = json.loads(payload)
+            client_id = data.get("client_id", "unknown")
+
+            if topic == "server/request/mobile":
+                state = data.get("state").lower()
+                device_id = data.get("device_id") or self.settings.default_device_id
+                logger.info(f"Mobile state request from {client_id} for {device_id}: {state}")
+                if state == "unlock":
+                    self.publish_state(client, {"state": "unlock", "client_id": "server", "reason": "null", "device_id": device_id})
+                    registry.update(
+                        device_id,
+                        state="unlock",
+                        last_alert_time=None,
+                        last_distance_alert_time=None,
+                        last_wire_alert_time=None,
+                        reference_gps_lat=None,
+                        reference_gps_lon=None,
+                        gps_lat=None,
+                        gps_lon=None,
+                        timeout_status=False
+                    )
+                    self.disarm_geofence(device_id)
+                elif state == "lock":
+                    device = registry.get(device_id)
+                    self.publish_state(client, {"state": "lock", "client_id": "server", "reason": "null", "device_id": device_id})
+                    registry.update(
+                        device_id,
+                        state="lock",
+                        last_alert_time=self.clock(),
+                        last_distance_alert_time=None,
+                        last_wire_alert_time=None,
+                        timeout_status=False
+                    )
+                    self.arm_timeout(device_id)
+                    if device and device["last_diagnostic_time"] is not None:
+                        reference_gps_lat = device["gps_lat"]
+                        reference_gps_lon = device["gps_lon"]
+                        if reference_gps_lat is not None and reference_gps_lon is not None:
+                            registry.update(device_id, reference_gps_lat=reference_gps_lat, reference_gps_lon=reference_gps_lon)
+                            logger.info(f"Set reference GPS for lock of {device_id}: lat={reference_gps_lat}, lon={reference_gps_lon}")
+                            self.arm_geofence(device_id, reference_gps_lat, reference_gps_lon)
+                else:
+                    logger.warning(f"Invalid state request from {client_id}: {state}")
+
+            elif topic == "server/test":
+                value = data.get("value", 0)
+                command = "ON" if value > 50 else "OFF"
+                command_topic = self.settings.command_topic
+                result = client.publish(command_topic, command, qos=1)
+                if result.rc == MQTT_ERR_SUCCESS:
+                    logger.info(f"Published command: {command} to {command_topic}")
+                else:
+                    logger.error(f"Failed to publish command to {command_topic}")
+
+        except Exception as e:
+            logger.error(f"Error processing message on {msg.topic}: {e}")
+
+    def on_connect_fail(self, client, userdata):
+        logger.error("Connection to MQTT broker failed")
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.intentional_disconnect:
+            logger.info("Intentional disconnection, no reconnection attempted")
+            return
+        logger.info(f"Unexpected disconnection with result code {rc}")
+        # A client on its own network thread (HTTP process) is reconnected by paho itself
+        if userdata and userdata.get("background"):
+            return
+        if not self.scheduler.is_armed("reconnect"):
+            logger.info(f"Reconnecting in {self.reconnect_delay} seconds...")
+            self.scheduler.arm_in("reconnect", self.reconnect_delay, self.reconnect_job)
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # paho keeps reporting is_connected() after an unexpected drop until the next connect, so
+    # also require a live socket
+    @staticmethod
+    def broker_connected(client):
+        return client.is_connected() and client.socket() is not None
+
+    # Shared publish path: timed per topic and counted on failure in /metrics.
+    # Durable messages go to the outbox instead when the broker is unreachable, and also while
+    # older ones are still queued there so they are not overtaken.
+    def publish_message(self, client, topic, message, qos=None, durable=False, priority=PRIORITY_STATE):
+        payload = serialize(message)
+        qos = self.publisher.qos_for(topic) if qos is None else qos
+        outbox = self.outbox
+        durable = durable and outbox is not None
+        if durable and (outbox.pending() or not self.broker_connected(client)):
+            return self.queue_message(topic, payload, qos, priority)
+        with self.publish_seconds.time(topic):
+            result = client.publish(topic, payload, qos=qos)
+        if result.rc == MQTT_ERR_SUCCESS:
+            logger.debug(f"Sent `{payload.decode('utf-8')}` to topic {topic}")
+            return True
+        self.publish_failures.inc(topic)
+        # The connection dropped between the check and the publish: queue it as well (paho may
+        # still deliver its own copy, so subscribers can see a duplicate)
+        if durable:
+            return self.queue_message(topic, payload, qos, priority)
+        logger.error(f"Failed to send message to topic {topic}")
+        return False
+
+    def queue_message(self, topic, payload, qos, priority):
+        if not self.outbox.put(topic, payload, qos, priority):
+            return False
+        self.outbox_queued.inc()
+        logger.info(f"Queued message for {topic} in the outbox ({self.outbox.pending()} pending)")
+        return True
+
+    # Outbox drain: hand a queued message to the client, only while connected
+    def send_queued(self, topic, payload, qos):
+        client = self.client
+        if not self.broker_connected(client):
+            return False
+        with self.publish_seconds.time(topic):
+            result = client.publish(topic, payload, qos=qos)
+        if result.rc != MQTT_ERR_SUCCESS:
+            self.publish_failures.inc(topic)
+            return False
+        return True
+
+    # Separate publish functions for each topic
+    def publish_data(self, client, message):
+        self.publish_message(client, "esp32/data", message)
+
+    # Lock/unlock and alerts must survive a broker outage; alerts jump the outbox queue
+    def publish_state(self, client, message):
+        priority = PRIORITY_ALERT if message.get("state") == "alert" else PRIORITY_STATE
+        self.publish_message(client, "esp32/alter/state", message, durable=True, priority=priority)
+
+    def publish_mode(self, client, message):
+        self.publish_message(client, "esp32/alter/mode", message)
+
+    def publish_gps(self, client, message):
+        self.publish_message(client, "esp32/alter/gps", message)
+
+    # Diagnostics fan-out: esp32/data plus the "updated" notice, at most once per device per window
+    # and only when the data payload changed
+    def publish_device_update(self, client_id, data):
+        self.publisher.coalesce(client_id, [
+            ("esp32/data", data),
+            ("esp32/alter/state", {"state": "updated", "client_id": client_id, "reason": "null"})
+        ])
+
+    # Main process reader connection, opened on first use
+    def reader_connection(self):
+        if self.stats_conn is None:
+            self.stats_conn = db_writer.connect(self.settings.db_path)
+        return self.stats_conn
+
+    def publish_statistics(self, client):
+        topic = "mobile/statistics"
+        try:
+            cursor = self.reader_connection().cursor()
+            # One snapshot per device from the materialized latest_state table
+            cursor.execute("""
+                SELECT time, state, gps_lat, gps_lon, battery_level, reason, client_id
+                FROM latest_state
+                ORDER BY client_id
+            """)
+            rows = cursor.fetchall()
+            if not rows:
+                logger.debug("No statistics data available to publish")
+            for row in rows:
+                message = {
+                    "time_sent": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])),
+                    "state": row[1],
+                    "gps_lat": row[2] if row[2] is not None else "unknown",
+                    "gps_lon": row[3] if row[3] is not None else "unknown",
+                    "battery_level": row[4],
+                    "reason": row[5],
+                    "client_id": row[6]
+                }
+                # Unchanged snapshots are skipped until publish_repeat_seconds has passed
+                self.publisher.publish(topic, message, key=row[6], dedupe=True)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to query statistics: {e}")
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # Reconnection (main process): one attempt per scheduler run with exponential backoff, retried
+    # until the broker is back, so timers keep firing and alerts keep queueing in the meantime
+    def reconnect_job(self, key, current_time):
+        if self.intentional_disconnect or self.broker_connected(self.client):
+            return
+        try:
+            logger.info(f"Connecting to {self.settings.broker}:{self.settings.port}")
+            self.client.reconnect()
+            logger.info("Reconnected, waiting for the broker to accept the session")
+            return
+        except Exception as err:
+            logger.error(f"Reconnect failed: {err}")
+        self.reconnect_delay = min(self.reconnect_delay * RECONNECT_RATE, MAX_RECONNECT_DELAY)
+        logger.info(f"Reconnecting in {self.reconnect_delay} seconds...")
+        self.scheduler.arm(key, current_time + self.reconnect_delay, self.reconnect_job)
+
+    # Persist a parsed diagnostics reading, update device state and publish (runs on ingest workers)
+    def process_diagnostics(self, reading):
+        registry = self.registry
+        clock = self.clock
+        client_id = reading["client_id"]
+        gps_lat = reading["gps_lat"]
+        gps_lon = reading["gps_lon"]
+        battery_level = reading["battery_level"]
+        state = reading["state"]
+        reason = reading["reason"]
+
+        device = registry.get(client_id) or {"state": "unknown", "timeout_status": False, "last_wire_alert_time": None}
+        current_state = device["state"]
+
+        # Store in database (group-committed by the writer thread), unless the reading adds
+        # nothing to the stored track (a parked bike repeating its state)
+        row = (
+            reading["received_at"],
+            state if state else current_state,
+            gps_lat,
+            gps_lon,
+            str(battery_level) if battery_level is not None else "unknown",
+            reason if reason else "null",
+            client_id
+        )
+        if self.track.keep(client_id, row[0], row[1], gps_lat, gps_lon, row[4], row[5]):
+            if self.statistics_writer is not None:
+                try:
+                    self.statistics_writer.write(row, durability=self.settings.db_durability)
+                except Exception as e:
+                    logger.error(f"Failed to store diagnostics in database: {e}")
+        else:
+            self.track_skipped.inc()
+
+        # Update device state
+        if device["timeout_status"]:
+            current_state = "alert"
+        else:
+            current_state = state if state else current_state
+        registry.update(
+            client_id,
+            last_diagnostic_time=clock(),
+            gps_lat=gps_lat,
+            gps_lon=gps_lon,
+            battery_level=battery_level,
+            state=current_state
+        )
+
+        # Check for wire alert
+        last_wire_alert_time = device["last_wire_alert_time"]
+        if reason == "wire" and (last_wire_alert_time is None or (clock() - last_wire_alert_time) > WIRE_ALERT_COOLDOWN):
+            logger.info(f"Wire alert triggered from {client_id}")
+            self.publish_state(self.client, {"state": "alert", "client_id": "server", "reason": "wire", "device_id": client_id})
+            self.alerts.inc("wire")
+            current_state = "alert"
+            registry.update(client_id, state="alert", last_wire_alert_time=clock())
+
+        # Publish to MQTT topics
+        self.publish_device_update(client_id, {
+            "gps_lat": gps_lat if gps_lat is not None else "unknown",
+            "gps_lon": gps_lon if gps_lon is not None else "unknown",
+            "battery_level": battery_level if battery_level is not None else "unknown",
+            "state": current_state,
+            "reason": reason if reason else "null",
+            "client_id": client_id
+        })
+
+    # Parse a JSON diagnostics body into a single reading
+    def parse_json_diagnostics(self, body):
+        post_data = body.decode('utf-8')
+        data = json.loads(post_data)
+        client_id = data.get("client_id", "unknown")
+        # Reject ids the registry cannot key (answered 400) before the reading is queued
+        DeviceRegistry._encode_key(client_id)
+        gps_lat = data.get("gps_lat")
+        gps_lon = data.get("gps_lon")
+
+        logger.debug(f"Received POST /diagnostics from {client_id}: {post_data}")
+        self.log_signal("POST /diagnostics", post_data)
+
+        # Validate and convert GPS coordinates
+        try:
+            gps_lat = float(gps_lat) if gps_lat and gps_lat != "unknown" else None
+            gps_lon = float(gps_lon) if gps_lon and gps_lon != "unknown" else None
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Invalid GPS data: lat={gps_lat}, lon={gps_lon}, error={e}")
+            gps_lat, gps_lon = None, None
+
+        return [{
+            "client_id": client_id,
+            "gps_lat": gps_lat,
+            "gps_lon": gps_lon,
+            "battery_level": data.get("battery_level"),
+            "state": data.get("state"),
+            "reason": data.get("reason"),
+            "received_at": self.clock()
+        }]
+
+    # Parse a binary frame (one or more readings from one device, oldest first)
+    def parse_frame_diagnostics(self, body):
+        readings = frames.decode(body, self.clock())
+        if readings:
+            logger.debug(f"Received POST /diagnostics frame from {readings[0]['client_id']} with {len(readings)} readings")
+        for reading in readings:
+            self.log_signal("POST /diagnostics", json.dumps({key: reading[key] for key in FRAME_LOG_FIELDS}))
+        return readings
+
+    def record_commit(self, rows, seconds):
+        self.db_insert_seconds.observe(seconds)
+        self.db_rows.inc(amount=rows)
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # Set up MQTT client (paho and the TLS context are only loaded here)
+    def create_mqtt_client(self, client_id, subscribe=True, background=False):
+        import paho.mqtt.client as mqtt
+        settings = self.settings
+        if not all([settings.broker, settings.username, settings.password]):
+            raise ValueError("Missing broker settings (EMQX_BROKER, EMQX_USERNAME, EMQX_PASSWORD)")
+        mqtt_client = mqtt.Client(
+            client_id=client_id,
+            protocol=mqtt.MQTTv311,
+            userdata={"subscribe": subscribe, "background": background}
+        )
+        mqtt_client.username_pw_set(settings.username, settings.password)
+        if settings.use_tls:
+            if not os.path.exists(settings.ca_cert):
+                raise FileNotFoundError(f"CA certificate file not found: {settings.ca_cert}")
+            mqtt_client.tls_set(
+                ca_certs=settings.ca_cert,
+                cert_reqs=ssl.CERT_REQUIRED,
+                tls_version=ssl.PROTOCOL_TLSv1_2
+            )
+            mqtt_client.tls_insecure_set(False)
+        mqtt_client.reconnect_delay_set(min_delay=FIRST_RECONNECT_DELAY, max_delay=MAX_RECONNECT_DELAY)
+        mqtt_client.enable_logger(logger)
+        mqtt_client.on_connect = self.on_connect
+        mqtt_client.on_connect_fail = self.on_connect_fail
+        mqtt_client.on_message = self.on_message
+        mqtt_client.on_disconnect = self.on_disconnect
+        return mqtt_client
+
+    # Signal handler for clean shutdown
+    def handle_signal(self, sig, frame):
+        logger.info("Signal received, shutting down")
+        self.intentional_disconnect = True
+        if self.network and self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+        if self.http_process is not None:
+            self.http_process.terminate()
+        logger.info("MQTT client stopped")
+        sys.exit(0)
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # Scheduled jobs (main process). Each job receives its scheduler key and the current time
+    # and re-arms itself, so the main loop only wakes when a deadline is actually due.
+
+    # Diagnostics timeout for one device: alert after 30 seconds of silence, repeating every 30 seconds
+    def check_timeout(self, key, current_time):
+        device_id = key[1]
+        device = self.registry.get(device_id)
+        if device is None:
+            return
+        last_diagnostic_time = device["last_diagnostic_time"]
+        last_alert_time = device["last_alert_time"]
+        next_check = current_time + DIAGNOSTICS_TIMEOUT
+        if last_diagnostic_time is not None:
+            if (device["state"] != "unlock" and
+                (current_time - last_diagnostic_time) >= DIAGNOSTICS_TIMEOUT and
+                (last_alert_time is None or (current_time - last_alert_time) >= ALERT_REPEAT_INTERVAL)):
+                self.publish_state(self.client, {"state": "alert", "client_id": "server", "reason": "timeout", "device_id": device_id})
+                self.alerts.inc("timeout")
+                self.registry.update(device_id, state="alert", timeout_status=True, last_alert_time=current_time)
+                logger.info(f"Published alert for {device_id} due to no diagnostics messages for over {DIAGNOSTICS_TIMEOUT} seconds")
+                next_check = current_time + ALERT_REPEAT_INTERVAL
+            else:
+                # Diagnostics arrived since the timer was armed: push the deadline out
+                next_check = last_diagnostic_time + DIAGNOSTICS_TIMEOUT
+                if last_alert_time is not None:
+                    next_check = max(next_check, last_alert_time + ALERT_REPEAT_INTERVAL)
+                if next_check <= current_time:
+                    next_check = current_time + DIAGNOSTICS_TIMEOUT
+        self.scheduler.arm(key, next_check, self.check_timeout)
+
+    def arm_timeout(self, device_id):
+        key = ("timeout", device_id)
+        if not self.scheduler.is_armed(key):
+            self.scheduler.arm(key, self.clock(), self.check_timeout)
+
+    # Bikes locked inside their own zones alert when they leave all of them; other locked bikes
+    # alert when they move beyond GEOFENCE_RADIUS of their reference position
+    def check_geofence(self, key, current_time):
+        records = self.registry.records
+        for device_id, distance in self.fleet_geofence.breaches(records):
+            self.geofence_alert(device_id, current_time, f"movement >{GEOFENCE_RADIUS} meters: distance={distance:.2f}m")
+        for device_id in self.zone_geofence.breaches(records):
+            self.geofence_alert(device_id, current_time, f"leaving zones {', '.join(self.zone_geofence.zone_names(device_id))}")
+        if len(self.fleet_geofence) or len(self.zone_geofence):
+            self.scheduler.arm(key, current_time + self.settings.geofence_interval, self.check_geofence)
+
+    def geofence_alert(self, device_id, current_time, cause):
+        device = self.registry.get(device_id)
+        if device is None or device["state"] == "unlock" or device["reference_gps_lat"] is None:
+            self.disarm_geofence(device_id)
+            return
+        if device["last_distance_alert_time"] is None or (current_time - device["last_distance_alert_time"]) > ALERT_REPEAT_INTERVAL:
+            self.publish_state(self.client, {"state": "alert", "client_id": "server", "reason": "gps", "device_id": device_id})
+            self.alerts.inc("gps")
+            self.registry.update(device_id, state="alert", last_distance_alert_time=current_time)
+            logger.info(f"Published alert for {device_id} due to {cause}")
+
+    def arm_geofence(self, device_id, reference_gps_lat, reference_gps_lon):
+        slot = self.registry.slot(device_id)
+        zone_names = self.zone_geofence.lock(device_id, slot, reference_gps_lat, reference_gps_lon)
+        if zone_names:
+            self.fleet_geofence.remove(device_id)
+            logger.info(f"{device_id} locked inside zones {', '.join(zone_names)}")
+        else:
+            self.fleet_geofence.add(device_id, slot, reference_gps_lat, reference_gps_lon, GEOFENCE_RADIUS)
+        if not self.scheduler.is_armed("geofence"):
+            self.scheduler.arm_in("geofence", self.settings.geofence_interval, self.check_geofence)
+
+    def disarm_geofence(self, device_id):
+        self.fleet_geofence.remove(device_id)
+        self.zone_geofence.remove(device_id)
+
+    # Rebuild the zone index when the zones table changed; bikes whose zones were all deleted
+    # fall back to their reference radius
+    def reload_zones(self, key, current_time):
+        try:
+            conn = self.reader_connection()
+            version = zones.zones_version(conn)
+            if version != self.zones_loaded_version:
+                index = zones.load_zones(conn, self.settings.zones_grid_degrees)
+                self.zones_loaded_version = version
+                for device_id in self.zone_geofence.reload(index):
+                    device = self.registry.get(device_id)
+                    if device is not None and device["reference_gps_lat"] is not None:
+                        self.arm_geofence(device_id, device["reference_gps_lat"], device["reference_gps_lon"])
+                logger.info(f"Loaded {len(index)} zones")
+        except Exception as e:
+            logger.error(f"Failed to load zones: {e}")
+        self.scheduler.arm(key, current_time + self.settings.zones_reload_interval, self.reload_zones)
+
+    # Periodic statistics publishing
+    def publish_statistics_job(self, key, current_time):
+        self.publish_statistics(self.client)
+        publish_interval = 4 if any(device["state"] == "alert" for device in self.registry.devices()) else 10
+        self.scheduler.arm(key, current_time + publish_interval, self.publish_statistics_job)
+
+    # Devices first seen by the HTTP process get their timeout armed here
+    def discover_devices(self, key, current_time):
+        if len(self.registry) != self.known_device_count:
+            devices = self.registry.devices()
+            self.known_device_count = len(devices)
+            for device in devices:
+                self.arm_timeout(device["client_id"])
+        self.scheduler.arm(key, current_time + DEVICE_DISCOVERY_INTERVAL, self.discover_devices)
+
+    # Statistics retention: one chunk per run, re-armed right away while work remains
+    def compact_statistics(self, key, current_time):
+        if self.compactor.step():
+            self.scheduler.arm(key, current_time + COMPACTION_CHUNK_PAUSE, self.compact_statistics)
+            return
+        if self.compactor.rows_compacted:
+            logger.info(f"Statistics compaction done, {self.compactor.rows_compacted} raw rows rolled up so far")
+        self.scheduler.arm(key, current_time + self.settings.compaction_interval, self.compact_statistics)
+
+    # -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+    # Main process: MQTT loop and alert timers, with the HTTP ingest process alongside
+    def run(self):
+        settings = self.settings
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        try:
+            self.init_db()
+            if self.registry is None:
+                self.registry = DeviceRegistry.create(settings.device_capacity)
+            self.metrics.allocate()
+            self.http_process = Process(target=run_http_process, args=(settings, self.registry, self.metrics))
+            self.http_process.start()
+            self.signal_log = self.create_signal_log()
+            self.outbox = self.create_outbox("main")
+            self.compactor = Compactor(
+                settings.db_path,
+                raw_retention_days=settings.statistics_raw_days,
+                minute_retention_days=settings.statistics_minute_days,
+                hour_retention_days=settings.statistics_hour_days,
+                chunk_size=settings.compaction_chunk_rows,
+                clock=self.clock
+            )
+
+            if self.client is None:
+                self.client = self.create_mqtt_client(settings.client_id)
+            client = self.client
+            logger.info(f"Connecting to {settings.broker}:{settings.port}")
+            client.connect(str(settings.broker), settings.port, keepalive=120)
+
+            scheduler = self.scheduler
+            scheduler.arm("statistics", self.clock(), self.publish_statistics_job)
+            scheduler.arm("discovery", self.clock(), self.discover_devices)
+            scheduler.arm("zones", self.clock(), self.reload_zones)
+            scheduler.arm_in("compaction", settings.compaction_interval / 10, self.compact_statistics)
+            while not self.intentional_disconnect:
+                # Block on the MQTT socket until a message arrives or the next deadline is due;
+                # while disconnected there is no socket, so just wait for the next deadline
+                # (the reconnect attempt is one of them)
+                if client.loop(timeout=scheduler.time_until_next(MAX_LOOP_WAIT)) != MQTT_ERR_SUCCESS:
+                    time.sleep(scheduler.time_until_next(MAX_LOOP_WAIT))
+                scheduler.run_due()
+
+            if self.http_process is not None:
+                self.http_process.terminate()
+        except Exception as e:
+            logger.error(f"Error in server: {e}")
+            self.intentional_disconnect = True
+            if self.client is not None:
+                self.client.disconnect()
+                self.client.loop_stop()
+            if self.http_process is not None:
+                self.http_process.terminate()
+            sys.exit(1)
+        finally:
+            self.close()
+
+    # HTTP ingest process: serves HTTP on the registry and metrics shared by run()
+    def serve_http(self, shared_metrics):
+        settings = self.settings
+        self.metrics.attach(shared_metrics, row=1)
+        self.signal_log = self.create_signal_log()
+
+        self.statistics_writer = db_writer.StatisticsWriter(
+            settings.db_path,
+            batch_size=settings.db_batch_size,
+            flush_interval=settings.db_flush_ms / 1000,
+            on_commit=self.record_commit
+        )
+        self.statistics_writer.start()
+
+        # Publishes from this process need their own broker connection. It is opened (and
+        # re-opened after a drop) by paho's network thread, so ingest starts even while the
+        # broker is unreachable; alerts raised meanwhile wait in the outbox.
+        self.client = self.create_mqtt_client(f"{settings.client_id}-http", subscribe=False, background=True)
+        self.outbox = self.create_outbox("http")
+        self.client.connect_async(str(settings.broker), settings.port, keepalive=120)
+        self.client.loop_start()
+        self.publisher.start()
+
+        self.ingest_pool = WorkerPool("ingest", self.process_diagnostics, settings.ingest_workers, settings.ingest_queue_size, partitioned=True)
+        self.ingest_pool.start()
+        self.admission = Admission(settings.diagnostics_rate, settings.diagnostics_burst, max_devices=settings.device_capacity,
+                                   exempt_interval=WIRE_ALERT_COOLDOWN, clock=self.monotonic)
+        self.admission.on_collapsed = lambda count: self.diagnostics_collapsed.inc(amount=count)
+        self.admission.start(lambda reading: self.ingest_pool.submit(reading, key=reading["client_id"]))
+
+        # The main process stops this one with SIGTERM; unwind so queued readings, publishes and
+        # signals.log lines are flushed instead of lost with the process
+        signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        httpd = PooledHTTPServer((settings.http_host, settings.http_port), HealthCheckHandler, workers=settings.http_workers)
+        httpd.engine = self
+        logger.info(f"Starting HTTP server on port {settings.http_port}...")
+        try:
+            httpd.serve_forever()
+        finally:
+            self.admission.stop()
+            self.ingest_pool.stop()
+            self.publisher.stop()
+            self.outbox.stop()
+            self.statistics_writer.stop()
+            self.signal_log.stop()
+
+    # Release what this engine opened (run() calls this on exit; offline engines call it when done)
+    def close(self):
+        for resource in (self.signal_log, self.outbox, self.statistics_writer):
+            if resource is not None:
+                resource.stop()
+        self.signal_log = self.outbox = self.statistics_writer = None
+        if self.compactor is not None:
+            self.compactor.close()
+            self.compactor = None
+        if self.stats_conn is not None:
+            self.stats_conn.close()
+            self.stats_conn = None
+        if self.registry is not None and self.owns_registry:
+            self.registry.close()
+            self.registry = None
+
+# -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+# HTTP Server for Render Health Checks and ESP32 Communication (the server carries its engine)
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    # Drop connections from clients that stall mid-request instead of pinning a handler thread
+    timeout = 30
+
+    # Per-request access logs go to debug instead of stderr
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/commands":
+            self.handle_commands(parse_qs(url.query))
+        elif url.path == "/history":
+            self.handle_history(parse_qs(url.query))
+        elif url.path == "/zones":
+            self.handle_list_zones(parse_qs(url.query))
+        elif url.path == "/metrics":
+            body = self.server.engine.metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain")
+            self.end_headers()
+            self.wfile.write(b"Server is running")
+
+    # Commanded state for one ESP32. The ETag changes whenever the device's state does, so a
+    # poll with a matching If-None-Match gets 304; with ?wait=<seconds> that poll is held open
+    # until the state changes or the wait expires.
+    def handle_commands(self, query):
+        engine = self.server.engine
+        registry = engine.registry
+        device_id = query.get("client_id", [engine.settings.default_device_id])[0]
+        try:
+            DeviceRegistry._encode_key(device_id)
+        except ValueError as e:
+            self.send_json(400, {"status": "error", "message": str(e)})
+            return
+        device = registry.get(device_id)
+        version = device["version"] if device else 0
+        etag = f'"{registry.epoch:x}-{version}"'
+        if self.headers.get("If-None-Match") == etag:
+            try:
+                wait = min(float(query.get("wait", ["0"])[0]), engine.settings.commands_max_wait)
+            except ValueError:
+                wait = 0
+            # Long-polls are capped so they can't occupy every handler thread
+            if wait > 0 and engine.long_poll_slots.acquire(blocking=False):
+                try:
+                    device = registry.wait_for_change(device_id, version, wait)
+                finally:
+                    engine.long_poll_slots.release()
+                version = device["version"] if device else 0
+            new_etag = f'"{registry.epoch:x}-{version}"'
+            if new_etag == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            etag = new_etag
+        state = device["state"] if device else "unknown"
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(COMMAND_BODIES[state])
+        logger.debug(f"{device_id} polled /commands, returned state: {state}")
+
+    # Downsampled statistics for one device streamed as NDJSON:
+    # /history?client_id=<id>&from=<epoch>&to=<epoch>&max_points=<n>
+    def handle_history(self, query):
+        try:
+            client_id = query["client_id"][0]
+            end = float(query.get("to", [self.server.engine.clock()])[0])
+            start = float(query.get("from", [end - HISTORY_DEFAULT_RANGE])[0])
+            max_points = min(max(1, int(query.get("max_points", [HISTORY_MAX_POINTS])[0])), HISTORY_POINTS_LIMIT)
+            if not (math.isfinite(start) and math.isfinite(end)):
+                raise ValueError("'from' and 'to' must be finite")
+            if end <= start:
+                raise ValueError("'to' must be after 'from'")
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"status": "error", "message": f"Invalid history query: {e}"})
+            return
+
+        conn = self.server.engine.http_connection()
+
+        # Chunked HTTP/1.1 response so points are sent while the cursor is still reading
+        self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        lines = []
+        try:
+            for point in stream_history(conn, client_id, start, end, max_points):
+                lines.append(json.dumps(point))
+                if len(lines) >= HISTORY_CHUNK_LINES:
+                    self.write_chunk(lines)
+                    lines = []
+            self.write_chunk(lines)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to query history for {client_id}: {e}")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, lines):
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+
+    def send_json(self, status, body, retry_after=None):
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def do_POST(self):
+        engine = self.server.engine
+        if self.path == "/diagnostics":
+            try:
+                content_length = int(self.headers['Content-Length'])
+                body = self.rfile.read(content_length)
+                content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+                with engine.parse_seconds.time():
+                    if content_type == frames.CONTENT_TYPE:
+                        readings = engine.parse_frame_diagnostics(body)
+                    else:
+                        readings = engine.parse_json_diagnostics(body)
+            except Exception as e:
+                logger.error(f"Error processing POST /diagnostics: {e}")
+                self.send_json(400, {"status": "error", "message": str(e)})
+                return
+
+            if not self.admit_diagnostics(readings):
+                return
+
+            # Hand off persistence and publishing; readings from one device stay on one worker
+            for accepted, reading in enumerate(readings):
+                if not engine.ingest_pool.submit(reading, key=reading["client_id"]):
+                    engine.diagnostics_rejected.inc(amount=len(readings) - accepted)
+                    logger.warning(f"Ingest queue full, rejecting diagnostics from {reading['client_id']}")
+                    self.send_json(503, {"status": "error", "message": "ingest queue full", "accepted": accepted},
+                                   retry_after=engine.settings.ingest_retry_after)
+                    return
+            self.send_json(200, {"status": "success", "accepted": len(readings)})
+        elif self.path == "/zones":
+            self.handle_save_zone()
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    # Backpressure before ingest: a deep ingest queue refuses everything but wire alerts (503), and
+    # a device over its rate is refused (429) with its latest reading kept for later. A wire alert
+    # passes both only once per device per WIRE_ALERT_COOLDOWN; repeats are treated like any other
+    # request. Sends the response and returns False when the request is refused.
+    def admit_diagnostics(self, readings):
+        engine = self.server.engine
+        if not readings:
+            return True
+        client_id = readings[0]["client_id"]
+        settings = engine.settings
+        alert = any(reading["reason"] == "wire" for reading in readings) and engine.admission.claim_exemption(client_id)
+        if not alert and engine.ingest_pool.depth() >= settings.ingest_high_water * settings.ingest_queue_size:
+            engine.diagnostics_rejected.inc(amount=len(readings))
+            logger.warning(f"Ingest queue above high-water mark, rejecting diagnostics from {client_id}")
+            self.send_json(503, {"status": "error", "message": "ingest queue busy", "accepted": 0},
+                           retry_after=settings.ingest_retry_after)
+            return False
+        wait = engine.admission.admit(client_id, exempt=alert)
+        if wait:
+            engine.admission.defer(readings)
+            engine.diagnostics_rate_limited.inc()
+            logger.debug(f"Rate limiting diagnostics from {client_id}, next token in {wait:.2f}s")
+            self.send_json(429, {"status": "error", "message": "rate limited, latest reading kept", "accepted": 0},
+                           retry_after=Admission.retry_after(wait))
+            return False
+        return True
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        if url.path != "/zones":
+            self.send_response(404)
+            self.end_headers()
+            return
+        query = parse_qs(url.query)
+        try:
+            client_id, name = query["client_id"][0], query["name"][0]
+        except KeyError as e:
+            self.send_json(400, {"status": "error", "message": f"Missing parameter {e}"})
+            return
+        try:
+            deleted = zones.delete_zone(self.server.engine.http_connection(), client_id, name)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to delete zone {name} of {client_id}: {e}")
+            self.send_json(500, {"status": "error", "message": "database error"})
+            return
+        if not deleted:
+            self.send_json(404, {"status": "error", "message": "no such zone"})
+            return
+        logger.info(f"Deleted zone {name} of {client_id}")
+        self.send_json(200, {"status": "success"})
+
+    # Named zones of one bike: /zones?client_id=<id>
+    def handle_list_zones(self, query):
+        if "client_id" not in query:
+            self.send_json(400, {"status": "error", "message": "Missing parameter 'client_id'"})
+            return
+        client_id = query["client_id"][0]
+        try:
+            rows = self.server.engine.http_connection().execute(
+                "SELECT id, client_id, name, kind, geometry FROM zones WHERE client_id = ? ORDER BY name", (client_id,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to list zones of {client_id}: {e}")
+            self.send_json(500, {"status": "error", "message": "database error"})
+            return
+        self.send_json(200, {"client_id": client_id, "zones": [
+            zones.Zone(zone_id, owner, name, kind, json.loads(geometry)).to_dict()
+            for zone_id, owner, name, kind, geometry in rows
+        ]})
+
+    # Create or replace a zone:
+    # {"client_id", "name", "circle": {"lat", "lon", "radius"}} or {"client_id", "name", "polygon": [[lat, lon], ...]}
+    def handle_save_zone(self):
+        try:
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            zone = zones.zone_from_request(str(data["client_id"]), data)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {"status": "error", "message": f"Invalid zone: {e}"})
+            return
+        try:
+            zones.save_zone(self.server.engine.http_connection(), zone, self.server.engine.clock())
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save zone {zone.name} of {zone.client_id}: {e}")
+            self.send_json(500, {"status": "error", "message": "database error"})
+            return
+        logger.info(f"Saved {zone.kind} zone {zone.name} of {zone.client_id}")
+        self.send_json(200, {"status": "success", "zone": zone.to_dict()})
+
+# -/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/-/
+
+# Process entry points (module level so they can be started with any multiprocessing method)
+
+def run_http_process(settings, registry, shared_metrics):
+    Engine(settings, registry=registry).serve_http(shared_metrics)
+
+# One shard: the regular server with its own slice of devices, database file, internal HTTP
+# port and MQTT client id
+def run_shard(settings, index):
+    Engine(settings.replace(
+        shard_index=index,
+        db_path=shard_db_path(settings.db_path, index),
+        http_host="127.0.0.1",
+        http_port=settings.shard_port_base + index,
+        client_id=f"{settings.client_id}-shard{index}"
+    )).run()
+
+# Sharded mode: start the shards and serve the router; if a shard dies the whole server exits
+def run_sharded(settings):
+    if settings.client_id is None:
+        settings = settings.replace(client_id=f"python-mqtt-server-{random.randint(0, 1000)}")
+    shards = [Process(target=run_shard, args=(settings, index), name=f"shard-{index}") for index in range(settings.shards)]
+    for shard in shards:
+        shard.start()
+    router = ShardRouter(
+        (settings.http_host, settings.http_port),
+        [("127.0.0.1", settings.shard_port_base + index) for index in range(settings.shards)],
+        settings.default_device_id,
+        workers=settings.http_workers,
+        upstream_timeout=settings.commands_max_wait + 30
+    )
+    exit_code = 0
+    stopping = False
+
+    def watch_shards():
+        nonlocal exit_code
+        ended = wait_for_processes([shard.sentinel for shard in shards])
+        if not stopping:
+            failed = [shard.name for shard in shards if shard.sentinel in ended]
+            logger.error(f"Shard process exited unexpectedly: {', '.join(failed)}")
+            exit_code = 1
+            router.shutdown()
+
+    def stop(sig, frame):
+        nonlocal stopping
+        logger.info("Signal received, stopping shards")
+        stopping = True
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=watch_shards, name="shard-watch", daemon=True).start()
+    logger.info(f"Routing HTTP on port {settings.http_port} to {settings.shards} shards")
+    try:
+        router.serve_forever()
+    finally:
+        for shard in shards:
+            if shard.is_alive():
+                shard.terminate()
+        for shard in shards:
+            shard.join(10)
+    sys.exit(exit_code)
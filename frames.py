@@ -0,0 +1,103 @@
+import struct
+
+from device_registry import STATES
+
+# Compact binary /diagnostics payload, sent with Content-Type: application/x-bantaybike-diag
+#
+# Header (20 bytes, little-endian):
+#   magic     2s   b"BB"
+#   version   B    1
+#   count     B    number of readings that follow
+#   client_id 16s  UTF-8, NUL padded
+#
+# Reading (20 bytes each, oldest first):
+#   seq       I    device sequence number
+#   age       I    seconds between the reading and this POST (0 for live readings)
+#   state     B    index into device_registry.STATES; 0 = keep the server's state
+#   reason    B    index into REASONS
+#   battery   B    percent, 255 = unknown
+#   pad       x
+#   gps_lat   i    degrees * 1e7, INT32_MIN = unknown
+#   gps_lon   i    degrees * 1e7, INT32_MIN = unknown
+
+CONTENT_TYPE = "application/x-bantaybike-diag"
+MAGIC = b"BB"
+VERSION = 1
+CLIENT_ID_SIZE = 16
+MAX_READINGS = 255
+
+HEADER = struct.Struct(f"<2sBB{CLIENT_ID_SIZE}s")
+READING = struct.Struct("<IIBBBxii")
+
+REASONS = ("null", "wire", "gps", "timeout")
+REASON_CODES = {name: code for code, name in enumerate(REASONS)}
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+GPS_SCALE = 10_000_000
+GPS_UNKNOWN = -2 ** 31
+BATTERY_UNKNOWN = 255
+
+
+class FrameError(ValueError):
+    pass
+
+
+# client_id of a frame without decoding its readings (used for routing)
+def peek_client_id(body):
+    if len(body) < HEADER.size:
+        raise FrameError("Frame shorter than header")
+    return HEADER.unpack_from(body, 0)[3].rstrip(b"\x00").decode("utf-8")
+
+
+# Decode a frame into readings shaped like the parsed JSON ones (see process_diagnostics)
+def decode(body, received_at):
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise FrameError("Frame shorter than header")
+    magic, version, count, client_id = HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise FrameError(f"Unsupported frame (magic={magic!r}, version={version})")
+    if len(view) != HEADER.size + count * READING.size:
+        raise FrameError(f"Frame length {len(view)} does not match {count} readings")
+    client_id = client_id.rstrip(b"\x00").decode("utf-8")
+    if not client_id:
+        raise FrameError("Frame has no client_id")
+    readings = []
+    for seq, age, state, reason, battery, lat, lon in READING.iter_unpack(view[HEADER.size:]):
+        if state >= len(STATES) or reason >= len(REASONS):
+            raise FrameError(f"Invalid state/reason code in reading {seq}")
+        readings.append({
+            "client_id": client_id,
+            "gps_lat": None if lat == GPS_UNKNOWN else lat / GPS_SCALE,
+            "gps_lon": None if lon == GPS_UNKNOWN else lon / GPS_SCALE,
+            "battery_level": None if battery == BATTERY_UNKNOWN else battery,
+            "state": STATES[state] if state else None,
+            "reason": REASONS[reason],
+            "seq": seq,
+            "received_at": received_at - age,
+        })
+    readings.sort(key=lambda reading: reading["received_at"])
+    return readings
+
+
+# Build a frame; readings are dicts with the decode() keys plus an optional "age"
+def encode(client_id, readings):
+    if len(readings) > MAX_READINGS:
+        raise FrameError(f"At most {MAX_READINGS} readings per frame")
+    key = client_id.encode("utf-8")
+    if not key or len(key) > CLIENT_ID_SIZE:
+        raise FrameError(f"client_id must be 1-{CLIENT_ID_SIZE} bytes: {client_id!r}")
+    parts = [HEADER.pack(MAGIC, VERSION, len(readings), key)]
+    for reading in readings:
+        lat, lon = reading.get("gps_lat"), reading.get("gps_lon")
+        battery = reading.get("battery_level")
+        parts.append(READING.pack(
+            reading.get("seq", 0),
+            reading.get("age", 0),
+            STATE_CODES.get(reading.get("state"), 0),
+            REASON_CODES.get(reading.get("reason") or "null", 0),
+            BATTERY_UNKNOWN if battery is None else int(battery),
+            GPS_UNKNOWN if lat is None else round(lat * GPS_SCALE),
+            GPS_UNKNOWN if lon is None else round(lon * GPS_SCALE),
+        ))
+    return b"".join(parts)
@@ -0,0 +1,119 @@
+import math
+
+import numpy as np
+
+from device_registry import FIELD_OFFSETS, RECORD
+
+# Earth's radius in meters
+EARTH_RADIUS = 6371000.0
+
+# Bikes whose equirectangular distance is below this fraction of their radius are
+# "clearly inside" and skip the exact haversine; the approximation error at geofence
+# scales (tens of meters) is far below 1%
+PREFILTER_MARGIN = 0.9
+
+# Last known position of every registry slot, read straight from shared memory
+POSITION_DTYPE = np.dtype({
+    "names": ["gps_lat", "gps_lon"],
+    "formats": ["<f8", "<f8"],
+    "offsets": [FIELD_OFFSETS["gps_lat"], FIELD_OFFSETS["gps_lon"]],
+    "itemsize": RECORD.size,
+})
+
+
+# Haversine distance between two points in degrees (in meters)
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+# Vectorized haversine over arrays of degrees (in meters)
+def haversine_many(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(values) for values in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+# Cheap flat-earth distance (in meters), accurate for short distances
+def equirectangular_many(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(values) for values in (lat1, lon1, lat2, lon2))
+    x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS * np.hypot(x, y)
+
+
+# Reference positions of all geofenced (locked) bikes in contiguous arrays.
+# Removal swaps the last bike into the freed row so the arrays stay dense.
+class FleetGeofence:
+    def __init__(self, capacity=64):
+        self.device_ids = []
+        self._index = {}
+        self._slots = np.zeros(capacity, dtype=np.int64)
+        self._ref_lat = np.zeros(capacity)
+        self._ref_lon = np.zeros(capacity)
+        self._radius = np.zeros(capacity)
+
+    def __len__(self):
+        return len(self.device_ids)
+
+    def __contains__(self, device_id):
+        return device_id in self._index
+
+    def _grow(self):
+        capacity = len(self._slots) * 2
+        for name in ("_slots", "_ref_lat", "_ref_lon", "_radius"):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    # Add or replace a bike; slot is its index in the device registry
+    def add(self, device_id, slot, ref_lat, ref_lon, radius):
+        row = self._index.get(device_id)
+        if row is None:
+            row = len(self.device_ids)
+            if row == len(self._slots):
+                self._grow()
+            self.device_ids.append(device_id)
+            self._index[device_id] = row
+        self._slots[row] = slot
+        self._ref_lat[row] = float(ref_lat)
+        self._ref_lon[row] = float(ref_lon)
+        self._radius[row] = radius
+
+    def remove(self, device_id):
+        row = self._index.pop(device_id, None)
+        if row is None:
+            return
+        last = len(self.device_ids) - 1
+        if row != last:
+            moved = self.device_ids[last]
+            self.device_ids[row] = moved
+            self._index[moved] = row
+            for array in (self._slots, self._ref_lat, self._ref_lon, self._radius):
+                array[row] = array[last]
+        self.device_ids.pop()
+
+    # Rows of bikes beyond their radius, with their distances in meters.
+    # Bikes without a known position (NaN) never breach.
+    def evaluate(self, lat, lon):
+        count = len(self.device_ids)
+        ref_lat, ref_lon, radius = self._ref_lat[:count], self._ref_lon[:count], self._radius[:count]
+        with np.errstate(invalid="ignore"):
+            approx = equirectangular_many(ref_lat, ref_lon, lat, lon)
+            candidates = np.flatnonzero(~(approx < radius * PREFILTER_MARGIN) & ~np.isnan(approx))
+            if len(candidates) == 0:
+                return candidates, np.empty(0)
+            distances = haversine_many(ref_lat[candidates], ref_lon[candidates], lat[candidates], lon[candidates])
+            outside = distances > radius[candidates]
+        return candidates[outside], distances[outside]
+
+    # Gather last known positions from the registry record table and evaluate the fleet
+    def breaches(self, records):
+        count = len(self.device_ids)
+        if count == 0:
+            return []
+        positions = np.frombuffer(records, dtype=POSITION_DTYPE)[self._slots[:count]]
+        rows, distances = self.evaluate(positions["gps_lat"], positions["gps_lon"])
+        return [(self.device_ids[row], float(distance)) for row, distance in zip(rows, distances)]
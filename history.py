@@ -0,0 +1,77 @@
+import heapq
+import time
+
+# Server-side downsampling for /history.
+# Rows are read through a cursor over the (client_id, time) index in time order and folded
+# into max_points equal time windows as they stream past, so memory stays constant no matter
+# how many readings the range covers. Each window is represented by its last reading, except
+# that an alert reading wins over later non-alert ones so alerts are never averaged away.
+# Ranges older than the raw retention window are served from the minute rollups written by
+# compaction.py, and ranges older than the minute retention from the hour rollups (only hours
+# that end before the device's oldest remaining minute bucket, so no reading is counted twice);
+# all cursors are already time ordered and are merged lazily.
+
+HISTORY_QUERY = """
+    SELECT time, state, gps_lat, gps_lon, battery_level, reason, 1
+    FROM statistics
+    WHERE client_id = ? AND time >= ? AND time < ?
+    ORDER BY time
+"""
+
+ROLLUP_HISTORY_QUERY = """
+    SELECT last_time, CASE WHEN alert_samples > 0 THEN 'alert' ELSE last_state END,
+           last_lat, last_lon, last_battery, last_reason, samples
+    FROM statistics_rollup
+    WHERE client_id = ? AND resolution = 60 AND bucket >= ? AND bucket < ?
+    ORDER BY bucket
+"""
+
+HOUR_HISTORY_QUERY = """
+    SELECT last_time, CASE WHEN alert_samples > 0 THEN 'alert' ELSE last_state END,
+           last_lat, last_lon, last_battery, last_reason, samples
+    FROM statistics_rollup
+    WHERE client_id = :client_id AND resolution = 3600 AND bucket >= :start AND bucket < :end
+      AND last_time < COALESCE(
+          (SELECT MIN(bucket) FROM statistics_rollup WHERE client_id = :client_id AND resolution = 60),
+          :end
+      )
+    ORDER BY bucket
+"""
+
+
+def _point(row, samples):
+    return {
+        "time": row[0],
+        "time_sent": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])),
+        "state": row[1],
+        "gps_lat": row[2] if row[2] is not None else "unknown",
+        "gps_lon": row[3] if row[3] is not None else "unknown",
+        "battery_level": row[4],
+        "reason": row[5],
+        "samples": samples,
+    }
+
+
+# Yield at most max_points downsampled readings for one device in [start, end)
+def stream_history(conn, client_id, start, end, max_points):
+    width = (end - start) / max_points
+    current_bucket, representative, samples = None, None, 0
+    rows = heapq.merge(
+        conn.execute(HOUR_HISTORY_QUERY, {"client_id": client_id, "start": start - 3600, "end": end}),
+        conn.execute(ROLLUP_HISTORY_QUERY, (client_id, start - 60, end)),
+        conn.execute(HISTORY_QUERY, (client_id, start, end)),
+        key=lambda row: row[0]
+    )
+    for row in rows:
+        if not start <= row[0] < end:
+            continue
+        bucket = int((row[0] - start) // width)
+        if bucket != current_bucket:
+            if representative is not None:
+                yield _point(representative, samples)
+            current_bucket, representative, samples = bucket, None, 0
+        samples += row[6]
+        if representative is None or row[1] == "alert" or representative[1] != "alert":
+            representative = row
+    if representative is not None:
+        yield _point(representative, samples)
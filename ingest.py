@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+import zlib
+from http.server import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+# Fixed number of threads consuming bounded queues.
+# With partitioned=True every key is pinned to one worker (crc32 of the key), so items
+# for the same device are handled in arrival order and never concurrently.
+class WorkerPool:
+    def __init__(self, name, handler, workers=4, queue_size=1024, partitioned=False):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.partitioned = partitioned
+        queue_count = self.workers if partitioned else 1
+        per_queue = max(1, -(-int(queue_size) // queue_count))
+        self.queues = [queue.Queue(maxsize=per_queue) for _ in range(queue_count)]
+        self.threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            work_queue = self.queues[index if self.partitioned else 0]
+            thread = threading.Thread(target=self._run, args=(work_queue,), name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Started {self.workers} {self.name} workers")
+
+    # Returns False instead of blocking when the queue is full
+    def submit(self, item, key=None):
+        if self.partitioned and key is not None:
+            work_queue = self.queues[zlib.crc32(str(key).encode("utf-8")) % len(self.queues)]
+        else:
+            work_queue = self.queues[0]
+        try:
+            work_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return sum(work_queue.qsize() for work_queue in self.queues)
+
+    def _run(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                break
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.error(f"Error in {self.name} worker: {e}")
+
+    def stop(self, timeout=5):
+        for index in range(self.workers):
+            self.queues[index if self.partitioned else 0].put(_STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+
+# HTTPServer that accepts on the serving thread and hands each connection to a pool of
+# handler threads, instead of parsing one request at a time
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, server_address, handler_class, workers=16, backlog=256):
+        self.request_queue_size = backlog
+        super().__init__(server_address, handler_class)
+        self.pool = WorkerPool("http", self._handle, workers, backlog)
+        self.pool.start()
+
+    def process_request(self, request, client_address):
+        if not self.pool.submit((request, client_address)):
+            logger.warning(f"HTTP connection queue full, dropping connection from {client_address[0]}")
+            self.shutdown_request(request)
+
+    def _handle(self, item):
+        request, client_address = item
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.stop()
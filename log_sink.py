@@ -0,0 +1,148 @@
+import fcntl
+import glob
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+# Background writer for signals.log.
+# Records are queued by the request path and written in batches by one thread that keeps
+# the file open, flushes every flush_interval seconds and rotates by size or age into
+# gzip-compressed segments. When the queue is filling up only every sample_every-th record
+# is kept, and when it is full records are dropped, so ingest never waits on the disk.
+# The main and HTTP processes may share one file: rotation is serialized with a lock
+# file and a sink reopens the path when another process has rotated it.
+class SignalLog:
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, rotate_interval=0, backups=5,
+                 queue_size=10000, batch_size=500, flush_interval=1.0, sample_every=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_every = max(1, sample_every)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.high_water = int(queue_size * 0.8)
+        self.dropped = 0
+        self.sampled_out = 0
+        self._sample_counter = 0
+        self._file = None
+        self._opened_at = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="signal-log", daemon=True)
+        self.thread.start()
+
+    # Never blocks; returns False when the record was sampled out or dropped
+    def write(self, line):
+        if self.queue.qsize() >= self.high_water:
+            self._sample_counter += 1
+            if self._sample_counter % self.sample_every:
+                self.sampled_out += 1
+                return False
+        try:
+            self.queue.put_nowait(line)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._opened_at = time.time()
+
+    def _run(self):
+        self._open()
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                stopping = item is _STOP
+                batch = [item] if item is not None and not stopping else []
+                while not stopping and len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                if batch:
+                    self._file.write("".join(batch))
+                if stopping or time.monotonic() - last_flush >= self.flush_interval:
+                    self._file.flush()
+                    last_flush = time.monotonic()
+                    self._maybe_rotate()
+                if stopping:
+                    break
+        except OSError as e:
+            logger.error(f"Failed to write {self.path}: {e}")
+        finally:
+            if self._file is not None:
+                self._file.close()
+
+    def _maybe_rotate(self):
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+        # Another process rotated the file under us
+        if current is None or current.st_ino != os.fstat(self._file.fileno()).st_ino:
+            self._file.close()
+            self._open()
+            return
+        too_big = self.max_bytes and current.st_size >= self.max_bytes
+        too_old = self.rotate_interval and time.time() - self._opened_at >= self.rotate_interval
+        if too_big or too_old:
+            self._rotate()
+
+    def _rotate(self):
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            inode = os.fstat(self._file.fileno()).st_ino
+            self._file.close()
+            rotated = None
+            try:
+                # Re-check under the lock in case another process rotated first
+                current = os.stat(self.path)
+                if current.st_ino == inode and current.st_size > 0:
+                    rotated = f"{self.path}.{int(time.time() * 1000)}.{os.getpid()}"
+                    os.rename(self.path, rotated)
+            except FileNotFoundError:
+                pass
+            self._open()
+        if rotated:
+            threading.Thread(target=self._compress, args=(rotated,), daemon=True).start()
+
+    def _compress(self, rotated):
+        try:
+            with open(rotated, "rb") as source, gzip.open(f"{rotated}.gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+            segments = sorted(glob.glob(f"{self.path}.*.gz"))
+            for old in segments[:-self.backups] if self.backups else segments:
+                os.remove(old)
+        except OSError as e:
+            logger.error(f"Failed to compress rotated log {rotated}: {e}")
+
+    # Write out what is queued and stop the writer thread
+    def stop(self, timeout=5):
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
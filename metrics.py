@@ -0,0 +1,175 @@
+import bisect
+import threading
+import time
+from multiprocessing import RawArray
+
+# Prometheus-style counters and histograms shared by the MQTT and HTTP processes.
+# All series live in one RawArray with a row per process: each process only ever adds to
+# its own row (guarded by a thread lock), and a scrape sums the rows, so counts stay
+# correct across processes without a cross-process lock on the hot path.
+# Metrics must be declared before allocate(); gauges are evaluated at scrape time.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _Timer:
+    __slots__ = ("histogram", "label", "started")
+
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.label)
+
+
+class Counter:
+    def __init__(self, metrics, name, help_text, label=None, values=(None,)):
+        self.metrics = metrics
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = tuple(values)
+        self.offset = metrics._reserve(len(self.values))
+
+    def inc(self, label_value=None, amount=1):
+        self.metrics._add(self.offset + self.values.index(label_value), amount)
+
+    def render(self, totals):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for index, value in enumerate(self.values):
+            labels = f'{{{self.label}="{value}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {totals[self.offset + index]:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, metrics, name, help_text, label=None, values=(None,), buckets=LATENCY_BUCKETS):
+        self.metrics = metrics
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = tuple(values)
+        self.buckets = tuple(buckets)
+        # Per label value: one slot per bucket, +Inf, sum, count
+        self.width = len(self.buckets) + 3
+        self.offset = metrics._reserve(self.width * len(self.values))
+
+    def observe(self, seconds, label_value=None):
+        base = self.offset + self.values.index(label_value) * self.width
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        self.metrics._observe(base, bucket, len(self.buckets) + 1, seconds)
+
+    def time(self, label_value=None):
+        return _Timer(self, label_value)
+
+    def render(self, totals):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for index, value in enumerate(self.values):
+            base = self.offset + index * self.width
+            prefix = f'{self.label}="{value}",' if self.label else ""
+            cumulative = 0
+            for bucket, bound in enumerate(self.buckets + (float("inf"),)):
+                cumulative += totals[base + bucket]
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative:g}')
+            labels = f"{{{prefix.rstrip(',')}}}" if prefix else ""
+            lines.append(f"{self.name}_sum{labels} {totals[base + len(self.buckets) + 1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {totals[base + len(self.buckets) + 2]:g}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def render(self, totals):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value:g}"]
+
+
+class Metrics:
+    def __init__(self, processes=4):
+        self.processes = processes
+        self.families = []
+        self.size = 0
+        self.array = None
+        self.row = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, slots):
+        if self.array is not None:
+            raise RuntimeError("Metrics must be declared before allocate()")
+        offset = self.size
+        self.size += slots
+        return offset
+
+    def counter(self, name, help_text, label=None, values=(None,)):
+        family = Counter(self, name, help_text, label, values)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, help_text, label=None, values=(None,), buckets=LATENCY_BUCKETS):
+        family = Histogram(self, name, help_text, label, values, buckets)
+        self.families.append(family)
+        return family
+
+    def gauge(self, name, help_text, callback):
+        family = Gauge(name, help_text, callback)
+        self.families.append(family)
+        return family
+
+    def allocate(self):
+        self.array = RawArray("d", self.size * self.processes)
+
+    # Child processes receive the shared array and write to their own row
+    def __getstate__(self):
+        return {"array": self.array}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def attach(self, shared, row):
+        if row >= self.processes:
+            raise ValueError(f"Metrics row {row} out of range ({self.processes} processes)")
+        self.array = shared.array
+        self.row = row
+
+    def _add(self, index, amount):
+        if self.array is None:
+            return
+        index += self.row * self.size
+        with self._lock:
+            self.array[index] += amount
+
+    def _observe(self, base, bucket, sum_slot, seconds):
+        if self.array is None:
+            return
+        base += self.row * self.size
+        with self._lock:
+            self.array[base + bucket] += 1
+            self.array[base + sum_slot] += seconds
+            self.array[base + sum_slot + 1] += 1
+
+    def render(self):
+        totals = [0.0] * self.size
+        if self.array is not None:
+            for row in range(self.processes):
+                start = row * self.size
+                for index, value in enumerate(self.array[start:start + self.size]):
+                    totals[index] += value
+        lines = []
+        for family in self.families:
+            lines.extend(family.render(totals))
+        return "\n".join(lines) + "\n"
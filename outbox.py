@@ -0,0 +1,135 @@
+import logging
+import sqlite3
+import threading
+
+import db_writer
+
+logger = logging.getLogger(__name__)
+
+# Disk-backed queue for outbound messages that must not be lost while the broker is
+# unreachable (alerts, lock/unlock commands). Messages are kept in a small SQLite file and
+# drained by a background thread once send() succeeds again: alerts first, then everything
+# else, each in the order it was queued. The queue is bounded: when full, the oldest message
+# of the lowest priority is dropped to make room.
+
+PRIORITY_ALERT = 0
+PRIORITY_STATE = 1
+
+OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        priority INTEGER NOT NULL,
+        topic TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        qos INTEGER NOT NULL
+    )
+"""
+
+
+class Outbox:
+    def __init__(self, path, max_messages=10000, batch_size=100, retry_interval=1.0):
+        self.path = path
+        self.max_messages = max_messages
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.conn = db_writer.connect(path, check_same_thread=False)
+        self.conn.execute(OUTBOX_SCHEMA)
+        self.conn.commit()
+        self.count = self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.send = None
+        self.thread = None
+        self.running = False
+        self.dropped = 0
+        self.on_dropped = None
+        self.on_delivered = None
+        if self.count:
+            logger.info(f"Outbox {path} holds {self.count} undelivered messages")
+
+    # send(topic, payload, qos) -> True once the client has taken the message
+    def start(self, send):
+        self.send = send
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def pending(self):
+        return self.count
+
+    # Queue a message; returns False if it could not be stored
+    def put(self, topic, payload, qos, priority=PRIORITY_STATE):
+        try:
+            with self.lock, self.conn:
+                if self.count >= self.max_messages:
+                    self.conn.execute(
+                        "DELETE FROM outbox WHERE id = (SELECT id FROM outbox ORDER BY priority DESC, id LIMIT 1)"
+                    )
+                    self.count -= 1
+                    self.dropped += 1
+                    if self.on_dropped is not None:
+                        self.on_dropped()
+                self.conn.execute(
+                    "INSERT INTO outbox (priority, topic, payload, qos) VALUES (?, ?, ?, ?)",
+                    (priority, topic, payload, qos)
+                )
+                self.count += 1
+        except sqlite3.Error as e:
+            logger.error(f"Failed to queue message for {topic}: {e}")
+            return False
+        self.wakeup.set()
+        return True
+
+    # Wake the drain thread (e.g. after a reconnect)
+    def notify(self):
+        self.wakeup.set()
+
+    def _batch(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, topic, payload, qos FROM outbox ORDER BY priority, id LIMIT ?", (self.batch_size,)
+            ).fetchall()
+
+    def _delete(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+            self.count -= len(ids)
+        if self.on_delivered is not None:
+            self.on_delivered(len(ids))
+
+    # Send queued messages until the queue is empty or a send fails
+    def drain(self):
+        while self.count:
+            sent = []
+            try:
+                for row_id, topic, payload, qos in self._batch():
+                    if not self.send(topic, bytes(payload), qos):
+                        break
+                    sent.append(row_id)
+            finally:
+                if sent:
+                    self._delete(sent)
+            if not sent:
+                return False
+        return True
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.retry_interval)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            try:
+                before = self.count
+                if before and self.drain():
+                    logger.info(f"Outbox drained {before} queued messages")
+            except sqlite3.Error as e:
+                logger.error(f"Failed to drain outbox: {e}")
+
+    def stop(self, timeout=5):
+        self.running = False
+        if self.thread is not None:
+            self.wakeup.set()
+            self.thread.join(timeout)
+            self.thread = None
+        self.conn.close()
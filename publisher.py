@@ -0,0 +1,146 @@
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Outbound MQTT publish layer.
+#   publish()  - send now; with dedupe=True a payload equal to the last one sent for the same
+#                topic and key is skipped (until repeat_interval has passed, so late subscribers
+#                still see the current value)
+#   coalesce() - queue a group of messages for one key (a device) and send only the newest
+#                group per key once per window; the group is suppressed when its first message
+#                is unchanged, so companions like the "updated" notice only follow real changes
+# Payloads are serialized once by the caller-facing methods and compared as bytes.
+# send(topic, payload, qos) does the actual publish and returns True on success.
+
+
+def serialize(message):
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, dict):
+        return json.dumps(message).encode('utf-8')
+    return str(message).encode('utf-8')
+
+
+# "topic=qos,topic=qos" -> {topic: qos}
+def parse_qos(spec):
+    qos = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        topic, _, level = entry.rpartition("=")
+        if not topic or level not in ("0", "1", "2"):
+            raise ValueError(f"Invalid QoS entry: {entry}")
+        qos[topic] = int(level)
+    return qos
+
+
+class Publisher:
+    def __init__(self, send, window=0.5, qos=None, default_qos=1, repeat_interval=60, clock=time.monotonic):
+        self.send = send
+        self.window = window
+        self.qos = dict(qos or {})
+        self.default_qos = default_qos
+        self.repeat_interval = repeat_interval
+        self.clock = clock
+        self.last_sent = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.suppressed = 0
+        self.coalesced = 0
+        self.on_suppressed = None
+        self.on_coalesced = None
+
+    # With background=False groups are still queued, and the caller drives flush() itself
+    def start(self, background=True):
+        self.running = True
+        if not background:
+            return
+        self.thread = threading.Thread(target=self._run, name="mqtt-coalescer", daemon=True)
+        self.thread.start()
+        logger.info(f"Started publish coalescer (window={self.window}s)")
+
+    def qos_for(self, topic):
+        return self.qos.get(topic, self.default_qos)
+
+    # Whether payload differs from the last one sent for (topic, key), or the last one is stale
+    def _changed(self, topic, key, payload, now):
+        last = self.last_sent.get((topic, key))
+        return last is None or last[0] != payload or now - last[1] >= self.repeat_interval
+
+    def _send(self, topic, key, payload, now):
+        if self.send(topic, payload, self.qos_for(topic)):
+            with self.lock:
+                self.last_sent[(topic, key)] = (payload, now)
+            return True
+        return False
+
+    def publish(self, topic, message, key=None, dedupe=False):
+        payload = serialize(message)
+        now = self.clock()
+        if dedupe:
+            with self.lock:
+                changed = self._changed(topic, key, payload, now)
+            if not changed:
+                self._count_suppressed(topic)
+                return True
+        return self._send(topic, key, payload, now)
+
+    # messages: [(topic, message), ...]; the newest group per key wins within a window
+    def coalesce(self, key, messages):
+        group = [(topic, serialize(message)) for topic, message in messages]
+        if not self.running:
+            self._flush_group(key, group)
+            return
+        with self.lock:
+            replaced = self.pending.get(key)
+            self.pending[key] = group
+        if replaced is not None:
+            self.coalesced += 1
+            if self.on_coalesced is not None:
+                self.on_coalesced(replaced[0][0])
+
+    def _flush_group(self, key, group):
+        now = self.clock()
+        topic, payload = group[0]
+        with self.lock:
+            changed = self._changed(topic, key, payload, now)
+        if not changed:
+            self._count_suppressed(topic)
+            return
+        for topic, payload in group:
+            self._send(topic, key, payload, now)
+
+    def _count_suppressed(self, topic):
+        self.suppressed += 1
+        if self.on_suppressed is not None:
+            self.on_suppressed(topic)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for key, group in pending.items():
+            try:
+                self._flush_group(key, group)
+            except Exception as e:
+                logger.error(f"Failed to publish coalesced messages for {key}: {e}")
+
+    def depth(self):
+        return len(self.pending)
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.window)
+            self.flush()
+
+    # Send what is pending and stop the flush thread
+    def stop(self, timeout=5):
+        self.running = False
+        if self.thread is not None:
+            self.wakeup.set()
+            self.thread.join(timeout)
+            self.thread = None
+        self.flush()
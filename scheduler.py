@@ -0,0 +1,68 @@
+import heapq
+import itertools
+import time
+
+
+# Deadline scheduler keyed by name (e.g. ("timeout", client_id)).
+# Arming a key again replaces its previous deadline; stale heap entries are skipped
+# lazily, so arm/cancel are O(log n) and the caller only wakes when something is due.
+class DeadlineScheduler:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._heap = []
+        self._armed = {}
+        self._sequence = itertools.count()
+
+    def arm(self, key, deadline, callback):
+        entry = (deadline, next(self._sequence), key)
+        self._armed[key] = (entry, callback)
+        heapq.heappush(self._heap, entry)
+
+    def arm_in(self, key, delay, callback):
+        self.arm(key, self.clock() + delay, callback)
+
+    def cancel(self, key):
+        self._armed.pop(key, None)
+
+    def is_armed(self, key):
+        return key in self._armed
+
+    def deadline(self, key):
+        armed = self._armed.get(key)
+        return armed[0][0] if armed else None
+
+    def __len__(self):
+        return len(self._armed)
+
+    def _discard_stale(self):
+        while self._heap:
+            entry = self._heap[0]
+            armed = self._armed.get(entry[2])
+            if armed is not None and armed[0] is entry:
+                return entry
+            heapq.heappop(self._heap)
+        return None
+
+    def next_deadline(self):
+        entry = self._discard_stale()
+        return entry[0] if entry else None
+
+    # Seconds until the next deadline, capped at max_wait (never negative)
+    def time_until_next(self, max_wait):
+        deadline = self.next_deadline()
+        if deadline is None:
+            return max_wait
+        return min(max_wait, max(0.0, deadline - self.clock()))
+
+    # Run every callback whose deadline has passed; callbacks may re-arm their own key
+    def run_due(self):
+        now = self.clock()
+        fired = 0
+        while True:
+            entry = self._discard_stale()
+            if entry is None or entry[0] > now:
+                return fired
+            heapq.heappop(self._heap)
+            _, callback = self._armed.pop(entry[2])
+            callback(entry[2], now)
+            fired += 1
@@ -0,0 +1,203 @@
+import bisect
+import http.client
+import json
+import logging
+import os
+import zlib
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import frames
+from ingest import PooledHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Horizontal sharding by client_id.
+# A consistent-hash ring maps every client_id to one of K shards (each shard runs its own
+# MQTT loop, HTTP ingest process, registry, SQLite file and alert timers). The front router
+# below owns the public HTTP port and forwards each request to the shard that owns the
+# device it concerns; MQTT requests arrive through a shared subscription and are re-published
+# by the receiving shard to the owner's own topic when needed.
+
+RING_REPLICAS = 64
+
+# Request headers that only concern one hop
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "host", "proxy-connection", "te", "upgrade"}
+
+
+class HashRing:
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        self.shards = shards
+        points = sorted(
+            (zlib.crc32(f"shard-{shard}-{replica}".encode("utf-8")), shard)
+            for shard in range(shards) for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def owner(self, client_id):
+        if self.shards == 1:
+            return 0
+        index = bisect.bisect(self._hashes, zlib.crc32(client_id.encode("utf-8")))
+        return self._owners[index % len(self._owners)]
+
+
+# bantaybike.db -> bantaybike.shard2.db
+def shard_db_path(db_path, shard):
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{shard}{ext}"
+
+
+# Topic a shard listens on for mobile requests forwarded by its peers
+def shard_request_topic(shard):
+    return f"server/shard/{shard}/request/mobile"
+
+
+# The device a request is about: ?client_id=, the X-Client-Id header, or the body
+def request_client_id(path, headers, body, default):
+    url = urlparse(path)
+    query = parse_qs(url.query)
+    if "client_id" in query:
+        return query["client_id"][0]
+    if headers.get("X-Client-Id"):
+        return headers["X-Client-Id"]
+    if body:
+        if headers.get("Content-Type", "").split(";")[0].strip() == frames.CONTENT_TYPE:
+            return frames.peek_client_id(body)
+        data = json.loads(body.decode("utf-8"))
+        if not isinstance(data, dict):
+            raise ValueError("JSON body must be an object")
+        return str(data.get("client_id", "unknown"))
+    return default
+
+
+# Merge Prometheus text from every shard: each family's HELP/TYPE once, followed by the
+# samples of all shards tagged with shard="<n>"
+def merge_metrics(texts):
+    families = {}
+    for shard, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("#"):
+                kind, name = line.split()[1:3]
+                family = families.setdefault(name, {"HELP": None, "TYPE": None, "samples": []})
+                family[kind] = family[kind] or line
+            elif line and family is not None:
+                name, _, value = line.rpartition(" ")
+                if "{" in name:
+                    name = name.replace("{", f'{{shard="{shard}",', 1)
+                else:
+                    name = f'{name}{{shard="{shard}"}}'
+                family["samples"].append(f"{name} {value}")
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["HELP"], family["TYPE"]) if line)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+class RouterHandler(BaseHTTPRequestHandler):
+    timeout = 30
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_metrics()
+        elif path in ("/commands", "/history", "/zones"):
+            self.forward(None)
+        else:
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain")
+            self.end_headers()
+            self.wfile.write(b"Server is running")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.forward(self.rfile.read(length))
+
+    def do_DELETE(self):
+        self.forward(None)
+
+    def forward(self, body):
+        try:
+            client_id = request_client_id(self.path, self.headers, body, self.server.default_client_id)
+        except (ValueError, UnicodeDecodeError) as e:
+            self.send_error_json(400, f"Cannot route request: {e}")
+            return
+        shard = self.server.ring.owner(client_id)
+        headers = {key: value for key, value in self.headers.items() if key.lower() not in HOP_HEADERS}
+        try:
+            response = self.request_shard(shard, self.command, self.path, body, headers)
+        except OSError as e:
+            logger.error(f"Shard {shard} unreachable for {self.command} {self.path}: {e}")
+            self.send_error_json(503, f"shard {shard} unavailable", retry_after=1)
+            return
+        try:
+            self.relay(response)
+        finally:
+            response.conn.close()
+
+    def request_shard(self, shard, method, path, body, headers):
+        host, port = self.server.shards[shard]
+        # Long-polled /commands may be held for the shard's maximum wait
+        conn = http.client.HTTPConnection(host, port, timeout=self.server.upstream_timeout)
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.conn = conn
+        return response
+
+    # Copy the shard's response; bodies without a length (streamed /history) are passed
+    # through as they arrive and delimited by closing the connection
+    def relay(self, response):
+        self.send_response(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_HEADERS:
+                self.send_header(key, value)
+        if response.getheader("Content-Length") is None:
+            self.close_connection = True
+            self.send_header("Connection", "close")
+        self.end_headers()
+        while True:
+            data = response.read1(65536)
+            if not data:
+                break
+            self.wfile.write(data)
+
+    def send_metrics(self):
+        texts = []
+        for shard in range(len(self.server.shards)):
+            try:
+                response = self.request_shard(shard, "GET", "/metrics", None, {})
+                texts.append(response.read().decode("utf-8"))
+                response.conn.close()
+            except OSError as e:
+                logger.warning(f"Could not scrape shard {shard}: {e}")
+                texts.append("")
+        body = merge_metrics(texts).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, retry_after=None):
+        body = json.dumps({"status": "error", "message": message}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Public HTTP front end: shards is a list of (host, port), indexed like the ring
+class ShardRouter(PooledHTTPServer):
+    def __init__(self, server_address, shards, default_client_id, workers=16, upstream_timeout=90):
+        self.ring = HashRing(len(shards))
+        self.shards = shards
+        self.default_client_id = default_client_id
+        self.upstream_timeout = upstream_timeout
+        super().__init__(server_address, RouterHandler, workers=workers)
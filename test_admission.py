@@ -0,0 +1,69 @@
+from admission import Admission
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def reading(reason="null", seq=0):
+    return {"client_id": "B1", "reason": reason, "seq": seq}
+
+
+def make_admission(clock, submitted):
+    admission = Admission(rate=1, burst=1, clock=clock)
+    admission.start(lambda item: submitted.append(item) or True, background=False)
+    return admission
+
+
+def test_refused_readings_collapse_to_latest():
+    clock, submitted = Clock(), []
+    admission = make_admission(clock, submitted)
+    assert admission.admit("B1") == 0
+    assert admission.admit("B1") > 0
+    admission.defer([reading(seq=1), reading(seq=2)])
+    admission.defer([reading(seq=3)])
+    assert admission.collapsed == 2
+    assert admission.release() == 1.0
+    clock.now = 1.0
+    admission.release()
+    assert [item["seq"] for item in submitted] == [3]
+
+
+def test_wire_alert_is_not_lost_at_the_token_boundary():
+    clock, submitted = Clock(), []
+    admission = make_admission(clock, submitted)
+    assert admission.admit("B1") == 0
+    assert admission.admit("B1") > 0
+    admission.defer([reading(seq=1)])
+    # A wire alert without a token is still admitted; the older pending reading is dropped
+    assert admission.claim_exemption("B1")
+    assert admission.admit("B1", exempt=True) == 0
+    assert admission.pending == {}
+    # The next normal request waits for a token again
+    clock.now = 0.5
+    assert admission.admit("B1") > 0
+    clock.now = 1.0
+    assert admission.admit("B1") == 0
+
+
+def test_repeated_wire_posts_are_exempt_once_per_interval():
+    clock, submitted = Clock(), []
+    admission = make_admission(clock, submitted)
+    assert admission.admit("B1") == 0
+    assert admission.claim_exemption("B1")
+    assert admission.admit("B1", exempt=True) == 0
+    # A second wire post within the interval gets no exemption and waits for a token
+    clock.now = 0.5
+    assert not admission.claim_exemption("B1")
+    assert admission.admit("B1") > 0
+    admission.defer([reading("wire", seq=2)])
+    # Other devices keep their own exemption
+    assert admission.claim_exemption("B2")
+    clock.now = 5.0
+    assert admission.claim_exemption("B1")
+    assert admission.admit("B1", exempt=True) == 0
+    assert admission.pending == {}
@@ -0,0 +1,67 @@
+import db_writer
+from compaction import Compactor, DAY
+
+ROLLUP_COLUMNS = "last_time, last_state, last_reason, last_lat, last_lon, last_battery, samples"
+
+
+def make_database(path):
+    conn = db_writer.connect(str(path))
+    conn.execute("""
+        CREATE TABLE statistics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, state TEXT NOT NULL,
+            gps_lat REAL, gps_lon REAL, battery_level TEXT, reason TEXT, client_id TEXT
+        )
+    """)
+    Compactor.init_schema(conn.cursor())
+    conn.commit()
+    return conn
+
+
+def insert(conn, rows):
+    conn.executemany(
+        "INSERT INTO statistics (time, state, gps_lat, gps_lon, battery_level, reason, client_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+
+
+def compact(path, now):
+    compactor = Compactor(str(path), raw_retention_days=1, clock=lambda: now)
+    while compactor.step():
+        pass
+    compactor.close()
+
+
+def test_rollup_keeps_the_newest_reading(tmp_path):
+    path = tmp_path / "statistics.db"
+    conn = make_database(path)
+    # Inserted out of time order so the newest reading is not the last row
+    insert(conn, [
+        (0.0, "lock", 14.0, 121.0, "40", "null", "B1"),
+        (20.0, "alert", 14.2, 121.2, "70", "wire", "B1"),
+        (10.0, "lock", 14.1, 121.1, "50", "null", "B1"),
+    ])
+    compact(path, 2 * DAY)
+    for resolution in (60, 3600):
+        row = conn.execute(
+            f"SELECT {ROLLUP_COLUMNS} FROM statistics_rollup WHERE client_id = 'B1' AND resolution = ?", (resolution,)
+        ).fetchone()
+        assert row == (20.0, "alert", "wire", 14.2, 121.2, "70", 3)
+    assert conn.execute("SELECT COUNT(*) FROM statistics").fetchone()[0] == 0
+
+
+def test_later_chunk_replaces_last_columns_only_when_newer(tmp_path):
+    path = tmp_path / "statistics.db"
+    conn = make_database(path)
+    insert(conn, [(30.0, "lock", 14.3, 121.3, "60", "null", "B1")])
+    compact(path, 2 * DAY)
+    insert(conn, [
+        (5.0, "alert", 14.0, 121.0, "10", "wire", "B1"),
+        (45.0, "unlock", 14.4, 121.4, "80", "null", "B1"),
+        (40.0, "lock", 14.5, 121.5, "90", "null", "B1"),
+    ])
+    compact(path, 2 * DAY)
+    row = conn.execute(
+        f"SELECT {ROLLUP_COLUMNS} FROM statistics_rollup WHERE client_id = 'B1' AND resolution = 60"
+    ).fetchone()
+    assert row == (45.0, "unlock", "null", 14.4, 121.4, "80", 4)
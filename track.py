@@ -0,0 +1,40 @@
+from geofence import haversine
+
+# Dead-band compression of the stored diagnostics track, applied as readings arrive.
+# A reading is stored when it adds information: the first one of a device, a change of state,
+# reason or battery level, a GPS fix appearing or disappearing, a position more than
+# `tolerance` meters from the last stored one, or `heartbeat` seconds since the last stored
+# reading. Every skipped reading is within `tolerance` of the stored reading before it, so
+# holding each stored position until the next one reconstructs the track within the tolerance.
+
+
+class TrackCompressor:
+    # tolerance <= 0 stores every reading
+    def __init__(self, tolerance=10.0, heartbeat=60.0):
+        self.tolerance = tolerance
+        self.heartbeat = heartbeat
+        self._last = {}
+
+    def __len__(self):
+        return len(self._last)
+
+    # Whether the reading should be stored; remembers it as the reference when it is.
+    # Calls for one device must not run concurrently (ingest workers are partitioned by device).
+    def keep(self, client_id, time, state, lat, lon, battery, reason):
+        reading = (time, state, lat, lon, battery, reason)
+        last = self._last.get(client_id)
+        if last is None or self.tolerance <= 0 or self._adds_information(last, reading):
+            self._last[client_id] = reading
+            return True
+        return False
+
+    def _adds_information(self, last, reading):
+        last_time, last_state, last_lat, last_lon, last_battery, last_reason = last
+        time, state, lat, lon, battery, reason = reading
+        if state != last_state or reason != last_reason or battery != last_battery:
+            return True
+        if time - last_time >= self.heartbeat:
+            return True
+        if (lat is None or lon is None) != (last_lat is None or last_lon is None):
+            return True
+        return lat is not None and lon is not None and haversine(last_lat, last_lon, lat, lon) > self.tolerance
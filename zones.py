@@ -0,0 +1,247 @@
+import json
+import logging
+import math
+
+import numpy as np
+
+from geofence import EARTH_RADIUS, POSITION_DTYPE, haversine
+
+logger = logging.getLogger(__name__)
+
+# Named geofences per bike (circles and polygons) behind a uniform-grid spatial index.
+# Each zone is registered in every grid cell its bounding box overlaps, so a position is
+# only tested against the zones in its own cell instead of every zone in the system.
+# Polygons are tested in the lat/lon plane, which is exact enough at parking-lot scale.
+
+METERS_PER_DEGREE = 2 * math.pi * EARTH_RADIUS / 360
+
+# Zones are posted by clients, so their size is bounded: circle radius (meters), bounding box
+# span (degrees, either axis), polygon vertices, and grid cells one zone may be registered in
+MAX_ZONE_RADIUS = 5000.0
+MAX_ZONE_SPAN_DEGREES = 0.5
+MAX_POLYGON_POINTS = 1000
+MAX_ZONE_CELLS = 10000
+
+ZONES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS zones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        geometry TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        UNIQUE (client_id, name)
+    )
+"""
+
+UPSERT_ZONE = """
+    INSERT INTO zones (client_id, name, kind, geometry, updated_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(client_id, name) DO UPDATE SET
+        kind = excluded.kind,
+        geometry = excluded.geometry,
+        updated_at = excluded.updated_at
+"""
+
+# Changes whenever a zone is added, replaced or deleted
+ZONES_VERSION = "SELECT COUNT(*), TOTAL(id), MAX(updated_at) FROM zones"
+
+
+def _valid_position(lat, lon):
+    return math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+class Zone:
+    __slots__ = ("zone_id", "client_id", "name", "kind", "geometry", "bbox", "_vertices")
+
+    # geometry: {"lat", "lon", "radius"} for circles, {"points": [[lat, lon], ...]} for polygons
+    def __init__(self, zone_id, client_id, name, kind, geometry):
+        self.zone_id = zone_id
+        self.client_id = client_id
+        self.name = name
+        self.kind = kind
+        self.geometry = geometry
+        if kind == "circle":
+            lat, lon, radius = float(geometry["lat"]), float(geometry["lon"]), float(geometry["radius"])
+            if not _valid_position(lat, lon) or not math.isfinite(radius) or radius <= 0:
+                raise ValueError("Circle needs a valid center and a positive radius")
+            if radius > MAX_ZONE_RADIUS:
+                raise ValueError(f"Circle radius is limited to {MAX_ZONE_RADIUS:g} meters")
+            dlat = radius / METERS_PER_DEGREE
+            dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+            self.bbox = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+            self._vertices = None
+        elif kind == "polygon":
+            vertices = [(float(lat), float(lon)) for lat, lon in geometry["points"]]
+            if len(vertices) < 3:
+                raise ValueError("Polygon needs at least 3 points")
+            if len(vertices) > MAX_POLYGON_POINTS:
+                raise ValueError(f"Polygon is limited to {MAX_POLYGON_POINTS} points")
+            if not all(_valid_position(lat, lon) for lat, lon in vertices):
+                raise ValueError("Polygon points need valid coordinates")
+            lats = [lat for lat, _ in vertices]
+            lons = [lon for _, lon in vertices]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+            self._vertices = vertices
+        else:
+            raise ValueError(f"Unknown zone kind: {kind}")
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if max_lat - min_lat > MAX_ZONE_SPAN_DEGREES or max_lon - min_lon > MAX_ZONE_SPAN_DEGREES:
+            raise ValueError(f"Zone is limited to {MAX_ZONE_SPAN_DEGREES:g} degrees across")
+
+    def contains(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.kind == "circle":
+            return haversine(self.geometry["lat"], self.geometry["lon"], lat, lon) <= self.geometry["radius"]
+        # Even-odd ray casting
+        inside = False
+        vertices = self._vertices
+        j = len(vertices) - 1
+        for i in range(len(vertices)):
+            lat_i, lon_i = vertices[i]
+            lat_j, lon_j = vertices[j]
+            if (lat_i > lat) != (lat_j > lat) and lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+                inside = not inside
+            j = i
+        return inside
+
+    def to_dict(self):
+        return {"name": self.name, "kind": self.kind, **self.geometry}
+
+
+# Build a Zone from a request body: {"name", "circle": {...}} or {"name", "polygon": [[lat, lon], ...]}
+def zone_from_request(client_id, data):
+    name = str(data["name"])
+    if "circle" in data:
+        return Zone(None, client_id, name, "circle", {key: float(data["circle"][key]) for key in ("lat", "lon", "radius")})
+    if "polygon" in data:
+        return Zone(None, client_id, name, "polygon", {"points": [[float(lat), float(lon)] for lat, lon in data["polygon"]]})
+    raise ValueError("Zone needs a 'circle' or a 'polygon'")
+
+
+class ZoneIndex:
+    def __init__(self, cell_degrees=0.01):
+        self.cell_degrees = cell_degrees
+        self.zones = {}
+        self._cells = {}
+        self._by_client = {}
+
+    def __len__(self):
+        return len(self.zones)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def add(self, zone):
+        min_lat, min_lon, max_lat, max_lon = zone.bbox
+        low, high = self._cell(min_lat, min_lon), self._cell(max_lat, max_lon)
+        cells = (high[0] - low[0] + 1) * (high[1] - low[1] + 1)
+        if cells > MAX_ZONE_CELLS:
+            raise ValueError(f"Zone covers {cells} grid cells (at most {MAX_ZONE_CELLS})")
+        self.zones[zone.zone_id] = zone
+        self._by_client.setdefault(zone.client_id, []).append(zone)
+        for row in range(low[0], high[0] + 1):
+            for column in range(low[1], high[1] + 1):
+                self._cells.setdefault((row, column), []).append(zone)
+
+    # Zones containing the point, optionally limited to a set of zone ids
+    def zones_at(self, lat, lon, zone_ids=None):
+        return [
+            zone for zone in self._cells.get(self._cell(lat, lon), ())
+            if (zone_ids is None or zone.zone_id in zone_ids) and zone.contains(lat, lon)
+        ]
+
+    def for_client(self, client_id):
+        return self._by_client.get(client_id, [])
+
+
+def init_schema(cursor):
+    cursor.execute(ZONES_SCHEMA)
+
+
+def zones_version(conn):
+    return conn.execute(ZONES_VERSION).fetchone()
+
+
+def load_zones(conn, cell_degrees=0.01):
+    index = ZoneIndex(cell_degrees)
+    for zone_id, client_id, name, kind, geometry in conn.execute("SELECT id, client_id, name, kind, geometry FROM zones"):
+        try:
+            index.add(Zone(zone_id, client_id, name, kind, json.loads(geometry)))
+        except Exception as e:
+            # One bad stored zone must not keep the rest (or the main loop) from loading
+            logger.warning(f"Skipping invalid zone {name!r} of {client_id}: {e}")
+    return index
+
+
+def save_zone(conn, zone, updated_at):
+    with conn:
+        conn.execute(UPSERT_ZONE, (zone.client_id, zone.name, zone.kind, json.dumps(zone.geometry), updated_at))
+
+
+def delete_zone(conn, client_id, name):
+    with conn:
+        return conn.execute("DELETE FROM zones WHERE client_id = ? AND name = ?", (client_id, name)).rowcount
+
+
+# Locked bikes guarded by their own zones: a bike locked inside one or more of its zones
+# breaches once its last known position is outside all of them
+class ZoneGeofence:
+    def __init__(self, index):
+        self.index = index
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __contains__(self, device_id):
+        return device_id in self._locks
+
+    # Start guarding a bike with the zones of its own that contain (lat, lon); returns their
+    # names, or [] when it is not inside any (the caller falls back to the reference radius)
+    def lock(self, device_id, slot, lat, lon):
+        own = {zone.zone_id for zone in self.index.for_client(device_id)}
+        zones = self.index.zones_at(lat, lon, own) if own else []
+        if not zones:
+            self.remove(device_id)
+            return []
+        self._locks[device_id] = (slot, frozenset(zone.zone_id for zone in zones))
+        return [zone.name for zone in zones]
+
+    def remove(self, device_id):
+        self._locks.pop(device_id, None)
+
+    def zone_names(self, device_id):
+        lock = self._locks.get(device_id)
+        return [self.index.zones[zone_id].name for zone_id in lock[1] if zone_id in self.index.zones] if lock else []
+
+    # Swap in a freshly loaded index; returns the bikes whose zones were all deleted
+    def reload(self, index):
+        self.index = index
+        orphaned = []
+        for device_id, (slot, zone_ids) in list(self._locks.items()):
+            remaining = frozenset(zone_id for zone_id in zone_ids if zone_id in index.zones)
+            if remaining:
+                self._locks[device_id] = (slot, remaining)
+            else:
+                del self._locks[device_id]
+                orphaned.append(device_id)
+        return orphaned
+
+    # Bikes whose last known position left every zone they were locked in.
+    # Bikes without a known position (NaN) never breach.
+    def breaches(self, records):
+        if not self._locks:
+            return []
+        device_ids = list(self._locks)
+        slots = np.fromiter((self._locks[device_id][0] for device_id in device_ids), dtype=np.int64, count=len(device_ids))
+        positions = np.frombuffer(records, dtype=POSITION_DTYPE)[slots]
+        breached = []
+        for device_id, lat, lon in zip(device_ids, positions["gps_lat"].tolist(), positions["gps_lon"].tolist()):
+            if math.isnan(lat) or math.isnan(lon):
+                continue
+            if not self.index.zones_at(lat, lon, self._locks[device_id][1]):
+                breached.append(device_id)
+        return breached